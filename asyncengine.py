@@ -0,0 +1,248 @@
+# asyncio based serving engine (alternative to http.server.ThreadingHTTPServer)
+
+import asyncio
+import email.utils
+import http.client
+import http.server as Hs
+import io
+import time
+
+
+
+class AsyncHandler:
+    """Stand-in for Hs.BaseHTTPRequestHandler, so that the Server.On* routes can be driven from
+    the event loop without change. Output is buffered and handed back to the engine in one piece."""
+
+    server_version = Hs.BaseHTTPRequestHandler.server_version
+    sys_version = Hs.BaseHTTPRequestHandler.sys_version
+    responses = Hs.BaseHTTPRequestHandler.responses
+
+    # logging behaves exactly like the threaded engine's handler, so borrow its implementation
+
+    monthname = Hs.BaseHTTPRequestHandler.monthname
+    weekdayname = Hs.BaseHTTPRequestHandler.weekdayname
+    _control_char_table = Hs.BaseHTTPRequestHandler._control_char_table
+    log_date_time_string = Hs.BaseHTTPRequestHandler.log_date_time_string
+    log_request = Hs.BaseHTTPRequestHandler.log_request
+    log_error = Hs.BaseHTTPRequestHandler.log_error
+    log_message = Hs.BaseHTTPRequestHandler.log_message
+
+    def __init__(self, command, path, request_version, headers, aBody, addrClient):
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.requestline = '{c} {p} {v}'.format(c=command, p=path, v=request_version)
+        self.headers = headers
+        self.client_address = addrClient
+        self.rfile = io.BytesIO(aBody)
+        self.wfile = io.BytesIO()
+        self.m_code = None
+        self.m_lStrHeader = []
+        self.m_fHasLength = False
+        self.m_fHeadersDone = False
+        self.m_fileSend = None      # (file, offset, count) to stream after the buffered response
+        self.close_connection = False
+
+    def send_response(self, code, message=None):
+        """Start the response with the given status code (mirrors BaseHTTPRequestHandler)"""
+
+        self.log_request(code)
+
+        if message is None:
+            message = self.responses.get(code, ('',))[0]
+
+        self.m_code = code
+        self.m_lStrHeader.append('{v} {c} {m}\r\n'.format(v='HTTP/1.1', c=code, m=message))
+        self.send_header('Server', self.version_string())
+        self.send_header('Date', email.utils.formatdate(time.time(), usegmt=True))
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self.m_fHasLength = True
+
+        # the engine writes the Connection header itself, from close_connection
+
+        if keyword.lower() == 'connection':
+            if value.lower() == 'close':
+                self.close_connection = True
+            return
+
+        self.m_lStrHeader.append('{k}: {v}\r\n'.format(k=keyword, v=value))
+
+    def end_headers(self):
+        self.m_fHeadersDone = True
+
+    def EndHeadersWithBody(self, abBody):
+        self.end_headers()
+        self.wfile.write(abBody)
+
+    def SendFile(self, fileIn, iBStart, cB):
+        """Queue cB bytes of fileIn from iBStart to be sent (via loop.sendfile) after the headers"""
+
+        self.m_fileSend = (fileIn, iBStart, cB)
+
+    def version_string(self):
+        return self.server_version + ' ' + self.sys_version
+
+    def address_string(self):
+        return self.client_address[0]
+
+    def AbResponse(self, fKeepAlive):
+        """Returns the full response (status line, headers, body) as bytes ready for the socket"""
+
+        aBody = self.wfile.getvalue()
+
+        if self.m_code is None:
+            # route never started a response; nothing sensible to send
+            return b''
+
+        lStr = list(self.m_lStrHeader)
+
+        # We always know the body length since it is buffered, so add one if the route didn't,
+        #  which is what allows keep-alive to work for every route
+
+        if not self.m_fHasLength and self.m_code not in (204, 304):
+            lStr.append('Content-Length: {c}\r\n'.format(c=len(aBody)))
+
+        lStr.append('Connection: {c}\r\n'.format(c='keep-alive' if fKeepAlive else 'close'))
+        lStr.append('\r\n')
+
+        return ''.join(lStr).encode('latin-1', 'strict') + aBody
+
+
+
+class AsyncEngine:
+    """Serves the Server routes (m_mpPathGet/m_mpPathPost) from a single asyncio event loop"""
+
+    s_cBHeaderMax = 64 * 1024
+    s_sTimeoutIdle = 30.0
+
+    def __init__(self, server):
+        self.m_server = server
+
+    def Run(self, addr, sock=None):
+        asyncio.run(self.Serve(addr, sock))
+
+    async def Serve(self, addr, sock=None):
+        if sock is not None:
+            aserver = await asyncio.start_server(self.OnConnection, sock=sock, limit=self.s_cBHeaderMax)
+        else:
+            host, port = addr
+            aserver = await asyncio.start_server(self.OnConnection, host or None, port, limit=self.s_cBHeaderMax)
+        async with aserver:
+            await aserver.serve_forever()
+
+    async def OnConnection(self, reader, writer):
+        """Handle requests on one connection until the client (or we) decide to close it"""
+
+        addrClient = writer.get_extra_info('peername') or ('-', 0)
+
+        try:
+            while await self.FHandleRequest(reader, writer, addrClient):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def LAbHeadRead(self, reader):
+        """Read a request line and then the header lines up to (and including) the blank one; an
+        empty list if the client closed the connection instead of sending another request"""
+
+        abLine = await reader.readline()
+        if not abLine:
+            return []
+
+        lAbHead = [abLine]
+        cB = 0
+        while True:
+            abHeader = await reader.readline()
+            cB += len(abHeader)
+            if cB > self.s_cBHeaderMax:
+                raise ValueError('headers too large')
+            lAbHead.append(abHeader)
+            if abHeader in (b'\r\n', b'\n', b''):
+                break
+
+        return lAbHead
+
+    async def FHandleRequest(self, reader, writer, addrClient):
+        """Read, dispatch and answer a single request. Returns True if the connection should stay open."""
+
+        # only waiting on the client is timed: an idle connection (or one trickling in its headers)
+        #  is dropped, but a big response to a slow reader takes as long as it takes
+
+        try:
+            lAbHead = await asyncio.wait_for(self.LAbHeadRead(reader), self.s_sTimeoutIdle)
+        except asyncio.TimeoutError:
+            return False
+
+        if not lAbHead:
+            return False
+
+        abLine, lAbHeader = lAbHead[0], lAbHead[1:]
+
+        lStrPart = abLine.decode('iso-8859-1').split()
+        if len(lStrPart) != 3:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+            return False
+
+        command, path, version = lStrPart
+
+        # let http.client parse the headers the same way BaseHTTPRequestHandler does so
+        #  handler.headers behaves identically
+
+        headers = http.client.parse_headers(io.BytesIO(b''.join(lAbHeader)))
+
+        # a body over the server's limit is left unread; the route rejects the request and the
+        #  connection is closed after. One that doesn't arrive in time gets the connection closed.
+
+        aBody = b''
+        strCl = headers.get('Content-Length')
+        if strCl and 0 < int(strCl) <= self.m_server.m_cBPostMax:
+            try:
+                aBody = await asyncio.wait_for(reader.readexactly(int(strCl)), self.m_server.m_sPostTimeout)
+            except asyncio.TimeoutError:
+                return False
+
+        strConn = headers.get('Connection', '').lower()
+        if version == 'HTTP/1.1':
+            fKeepAlive = strConn != 'close'
+        else:
+            fKeepAlive = strConn == 'keep-alive'
+
+        handler = AsyncHandler(command, path, version, headers, aBody, addrClient)
+
+        fOk = True
+        try:
+            if command == 'GET':
+                self.m_server.HandleGet(handler)
+            elif command == 'POST' and path in self.m_server.s_setPathPostSlow:
+                # these can wait on the credential pool, so keep them off of the event loop
+                await asyncio.to_thread(self.m_server.HandlePost, handler)
+            elif command == 'POST':
+                self.m_server.HandlePost(handler)
+            else:
+                handler.send_response(501)
+                handler.end_headers()
+        except Exception as exc:
+            # same outcome as the threaded engine: whatever was written goes out, then we hang up
+            handler.log_error('Exception handling request: %r', exc)
+            fOk = False
+
+        fKeepAlive = fKeepAlive and fOk and not handler.close_connection
+
+        writer.write(handler.AbResponse(fKeepAlive))
+        await writer.drain()
+
+        if handler.m_fileSend is not None:
+            fileIn, iBStart, cB = handler.m_fileSend
+            with fileIn:
+                await asyncio.get_running_loop().sendfile(writer.transport, fileIn, iBStart, cB)
+
+        return fKeepAlive
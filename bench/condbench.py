@@ -0,0 +1,73 @@
+# microbenchmark: compiled exit conditions vs. interpreting the raw yaml on each render
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import layout
+import session
+
+def LCondSynthetic():
+    """A few conditions wider/deeper than the example game has, to show short circuiting"""
+
+    lCondLeaf = [['gt', 'a', 0], ['eq', 'b', 3], ['ltvar', 'c', 'a'], ['ne', 'd', 7]]
+    return [
+            {'or' : lCondLeaf * 4},
+            {'and' : lCondLeaf * 4},
+            {'and' : [{'or' : lCondLeaf}, {'and' : lCondLeaf}, {'or' : [{'and' : lCondLeaf}] * 3}]},
+        ]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare compiled and interpreted exit conditions")
+    parser.add_argument('--layout', default=os.path.join(os.path.dirname(__file__), '..', 'example1', 'game.yml'))
+    parser.add_argument('--number', default=20000, type=int, help="Evaluations of each condition set per trial")
+    parser.add_argument('--seed', default=1, type=int)
+    args = parser.parse_args()
+
+    rooms = layout.Rooms()
+    rooms.Load(args.layout)
+
+    lCond = [exit.m_cond for room in rooms.m_mpNameRoom.values() for exit in room.LExit() if exit.m_cond is not None]
+    lCond.extend(LCondSynthetic())
+
+    lStrErr = []
+    lFn = [layout.FnCompileCond(cond, lStrErr) for cond in lCond]
+
+    # a handful of var states, checking both paths agree on every one
+
+    rng = random.Random(args.seed)
+    lSession = []
+    for _ in range(8):
+        sessionBench = session.Session()
+        for var in ('a', 'b', 'c', 'd', 'jackhammers', 'monsters', 'redbutton'):
+            sessionBench.m_mpVarVal[var] = rng.randint(0, 4)
+        lSession.append(sessionBench)
+
+    for sessionBench in lSession:
+        for cond, fn in zip(lCond, lFn):
+            assert sessionBench.FEvaluateCond(cond) == fn(sessionBench.m_mpVarVal), cond
+
+    def Interpreted():
+        for sessionBench in lSession:
+            for cond in lCond:
+                sessionBench.FEvaluateCond(cond)
+
+    def Compiled():
+        for sessionBench in lSession:
+            mpVarVal = sessionBench.m_mpVarVal
+            for fn in lFn:
+                fn(mpVarVal)
+
+    cEval = args.number // len(lSession)
+    sInterp = min(timeit.repeat(Interpreted, number=cEval, repeat=3))
+    sCompiled = min(timeit.repeat(Compiled, number=cEval, repeat=3))
+    cCond = cEval * len(lSession) * len(lCond)
+
+    print("{c} conditions, {n} evaluations each way".format(c=len(lCond), n=cCond))
+    print("  interpreted {s:8.3f}s  {u:6.2f}us/cond".format(s=sInterp, u=sInterp / cCond * 1e6))
+    print("  compiled    {s:8.3f}s  {u:6.2f}us/cond".format(s=sCompiled, u=sCompiled / cCond * 1e6))
+    print("  speedup     {x:8.1f}x".format(x=sInterp / sCompiled))
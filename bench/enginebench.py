@@ -0,0 +1,117 @@
+# throughput comparison between the serving engines (threading vs. asyncio)
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+s_pathRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def PathDataTemp():
+    """Copy example1 into a scratch directory (with an empty sessions dir) so runs don't touch the repo"""
+
+    pathDir = tempfile.mkdtemp(prefix='webadv-bench-')
+    shutil.copytree(os.path.join(s_pathRoot, 'example1'), pathDir, dirs_exist_ok=True)
+    os.makedirs(os.path.join(pathDir, 'sessions'), exist_ok=True)
+    return pathDir
+
+def ProcServerStart(strEngine, port, pathData, lStrArgExtra=()):
+    """Launch main.py with the given engine (and any extra arguments) and wait until it answers"""
+
+    lStrArg = [
+            sys.executable, os.path.join(s_pathRoot, 'main.py'),
+            '--datadir', pathData,
+            '--engine', strEngine,
+            '--port', str(port),
+        ]
+    lStrArg.extend(lStrArgExtra)
+    proc = subprocess.Popen(lStrArg, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            conn.close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+
+    proc.kill()
+    raise RuntimeError("server with engine {e} did not start".format(e=strEngine))
+
+def CReqClient(port, path, sDuration, fKeepAlive, queue):
+    """Client worker: issue GETs for sDuration seconds, report the number completed"""
+
+    cReq = 0
+    cErr = 0
+    dHeader = {} if fKeepAlive else {'Connection': 'close'}
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    sEnd = time.perf_counter() + sDuration
+
+    while time.perf_counter() < sEnd:
+        try:
+            conn.request('GET', path, headers=dHeader)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status == 200:
+                cReq += 1
+            else:
+                cErr += 1
+        except (OSError, http.client.HTTPException):
+            cErr += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+
+    conn.close()
+    queue.put((cReq, cErr))
+
+def DRun(strEngine, port, pathData, cClient, sDuration, path, fKeepAlive):
+    proc = ProcServerStart(strEngine, port, pathData)
+    try:
+        queue = multiprocessing.Queue()
+        lProc = [multiprocessing.Process(target=CReqClient, args=(port, path, sDuration, fKeepAlive, queue))
+                 for _ in range(cClient)]
+        for procClient in lProc:
+            procClient.start()
+        lResult = [queue.get() for _ in lProc]
+        for procClient in lProc:
+            procClient.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    cReq = sum(x[0] for x in lResult)
+    cErr = sum(x[1] for x in lResult)
+
+    return {
+            'engine' : strEngine,
+            'keepalive' : fKeepAlive,
+            'requests' : cReq,
+            'errors' : cErr,
+            'rps' : cReq / sDuration,
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare request throughput of the serving engines")
+    parser.add_argument('--clients', default=8, type=int, help="Number of concurrent client processes")
+    parser.add_argument('--seconds', default=5.0, type=float, help="Duration of each run")
+    parser.add_argument('--path', default='/login', help="Path to GET")
+    parser.add_argument('--port', default=8123, type=int, help="Port to run the server on")
+    args = parser.parse_args()
+
+    pathData = PathDataTemp()
+    try:
+        print("{c} clients, {s}s per run, GET {p}".format(c=args.clients, s=args.seconds, p=args.path))
+        for fKeepAlive in (False, True):
+            for strEngine in ('threading', 'asyncio'):
+                d = DRun(strEngine, args.port, pathData, args.clients, args.seconds, args.path, fKeepAlive)
+                print("  {e:<10} keepalive={k!s:<5} {r:>9.1f} req/s ({n} ok, {x} errors)".format(
+                        e=d['engine'], k=d['keepalive'], r=d['rps'], n=d['requests'], x=d['errors']))
+    finally:
+        shutil.rmtree(pathData, ignore_errors=True)
@@ -0,0 +1,79 @@
+# microbenchmark: pre-parsed room text vs. the old retry-on-KeyError formatting
+
+import argparse
+import collections
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import layout
+
+def StrFormatRetry(strIn, mpVarVal):
+    """The formatting Session.StrFormatSmart used to do: format, and on each KeyError add the
+    missing variable as 0 and try again"""
+
+    cIter = 100
+    while cIter > 0:
+        cIter -= 1
+        try:
+            return strIn.format(**mpVarVal)
+        except KeyError as ke:
+            mpVarVal[ke.args[0]] = 0
+
+    return "<could not format>"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare pre-parsed and retry formatting of room text")
+    parser.add_argument('--layout', default=os.path.join(os.path.dirname(__file__), '..', 'example1', 'game.yml'))
+    parser.add_argument('--number', default=2000, type=int, help="Passes over all room text per trial")
+    parser.add_argument('--seed', default=1, type=int)
+    args = parser.parse_args()
+
+    rooms = layout.Rooms()
+    rooms.Load(args.layout)
+
+    lText = []
+    for room in rooms.m_mpNameRoom.values():
+        lText.append(room.m_textDesc)
+        lText.extend(exit.m_textVerb for exit in room.LExit() if exit.m_textVerb is not None)
+
+    # sessions that know some of the variables the text uses but not all of them (a fresh player
+    #  knows none of them)
+
+    rng = random.Random(args.seed)
+    lMpVarVal = []
+    for _ in range(8):
+        mpVarVal = collections.defaultdict(int)
+        for var in ('jackhammers', 'monsters', 'fleas', 'bags'):
+            if rng.random() < 0.5:
+                mpVarVal[var] = rng.randint(0, 100)
+        lMpVarVal.append(mpVarVal)
+
+    for mpVarVal in lMpVarVal:
+        for text in lText:
+            assert text.StrFormat(mpVarVal) == StrFormatRetry(text.m_str, collections.defaultdict(int, mpVarVal))
+
+    def Retry():
+        # fresh copies each pass, since the retry approach fills in the missing variables
+        for mpVarVal in lMpVarVal:
+            mpVarVal = collections.defaultdict(int, mpVarVal)
+            for text in lText:
+                StrFormatRetry(text.m_str, mpVarVal)
+
+    def Parsed():
+        for mpVarVal in lMpVarVal:
+            mpVarVal = collections.defaultdict(int, mpVarVal)
+            for text in lText:
+                text.StrFormat(mpVarVal)
+
+    sRetry = min(timeit.repeat(Retry, number=args.number, repeat=3))
+    sParsed = min(timeit.repeat(Parsed, number=args.number, repeat=3))
+    cFormat = args.number * len(lMpVarVal) * len(lText)
+
+    print("{c} texts from {p}, {n} formats each way".format(c=len(lText), p=args.layout, n=cFormat))
+    print("  retry     {s:8.3f}s  {u:6.2f}us/format".format(s=sRetry, u=sRetry / cFormat * 1e6))
+    print("  parsed    {s:8.3f}s  {u:6.2f}us/format".format(s=sParsed, u=sParsed / cFormat * 1e6))
+    print("  speedup   {x:8.1f}x".format(x=sRetry / sParsed))
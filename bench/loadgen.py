@@ -0,0 +1,233 @@
+# end to end load generator: simulated players create accounts, log in, and wander the layout
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import enginebench
+
+s_reSid = re.compile(r'name="sid" id="sid" value="([0-9a-f]+)"')
+s_reDest = re.compile(r'name="dest" id="dest" value="([^"]*)"')
+s_reExit = re.compile(r'name="exit" id="exit" value="([^"]*)"')
+s_lStrRoute = ['/create', '/login', '/room']
+
+class Client:
+    """One client process's connection and its latency samples, by route"""
+
+    def __init__(self, port):
+        self.m_port = port
+        self.m_conn = None
+        self.m_mpRouteLS = {strRoute : [] for strRoute in s_lStrRoute}
+        self.m_mpRouteCErr = {strRoute : 0 for strRoute in s_lStrRoute}
+
+    def StrPost(self, strRoute, dPost):
+        """POST dPost (url encoded, as a browser would) to strRoute; returns the page, or None on failure"""
+
+        abBody = urllib.parse.urlencode(dPost).encode()
+        dHeader = {'Content-Type' : 'application/x-www-form-urlencoded'}
+
+        sStart = time.perf_counter()
+        try:
+            if self.m_conn is None:
+                self.m_conn = http.client.HTTPConnection('127.0.0.1', self.m_port, timeout=30)
+            self.m_conn.request('POST', strRoute, body=abBody, headers=dHeader)
+            resp = self.m_conn.getresponse()
+            strPage = resp.read().decode()
+            fOk = resp.status == 200
+        except (OSError, http.client.HTTPException):
+            if self.m_conn is not None:
+                self.m_conn.close()
+            self.m_conn = None
+            fOk = False
+
+        sLatency = time.perf_counter() - sStart
+
+        if not fOk:
+            self.m_mpRouteCErr[strRoute] += 1
+            return None
+
+        self.m_mpRouteLS[strRoute].append(sLatency)
+        return strPage
+
+def RunPlayer(client, uid, cMove, rng):
+    """Create uid, log in, enter the game, then take cMove random legal exits"""
+
+    strPwd = 'pw-' + uid
+    if client.StrPost('/create', {'login' : uid, 'pass' : strPwd, 'pass2' : strPwd}) is None:
+        return
+
+    strPage = client.StrPost('/login', {'login' : uid, 'pass' : strPwd})
+    match = s_reSid.search(strPage or '')
+    if match is None:
+        client.m_mpRouteCErr['/login'] += 1
+        return
+
+    sid = match.group(1)
+
+    # the login page just links to the current room ("Continue Your Adventure")
+
+    strPage = client.StrPost('/room', {'sid' : sid})
+    if strPage is None:
+        return
+
+    for _ in range(cMove):
+        # the page shows only the exits this player may take, one form each
+
+        lDest = s_reDest.findall(strPage)
+        lStrExit = s_reExit.findall(strPage)
+        if not lDest:
+            return
+
+        iExit = rng.randrange(len(lDest))
+        dPost = {'sid' : sid, 'dest' : lDest[iExit]}
+        if iExit < len(lStrExit):
+            dPost['exit'] = lStrExit[iExit]
+
+        strPage = client.StrPost('/room', dPost)
+        if strPage is None:
+            return
+
+def RunClient(port, lIPlayer, cMove, seed, strTag, queue):
+    """Client process: run each assigned player in turn, then report latencies"""
+
+    client = Client(port)
+    for iPlayer in lIPlayer:
+        # each player's walk depends only on the seed and its own number, not on scheduling
+
+        rng = random.Random(seed * 1000003 + iPlayer)
+        RunPlayer(client, '{t}{i}'.format(t=strTag, i=iPlayer), cMove, rng)
+
+    queue.put((client.m_mpRouteLS, client.m_mpRouteCErr))
+
+def SPercentile(lS, percent):
+    """Nearest-rank percentile of the sorted list lS"""
+
+    if not lS:
+        return 0.0
+    return lS[min(len(lS) - 1, max(0, int(round(percent / 100 * len(lS))) - 1))]
+
+def DRouteStats(lS, cErr, sWall):
+    lS = sorted(lS)
+    return {
+            'count' : len(lS),
+            'errors' : cErr,
+            'rps' : len(lS) / sWall if sWall else 0.0,
+            'mean_ms' : 1000 * sum(lS) / len(lS) if lS else 0.0,
+            'p50_ms' : 1000 * SPercentile(lS, 50),
+            'p95_ms' : 1000 * SPercentile(lS, 95),
+            'p99_ms' : 1000 * SPercentile(lS, 99),
+            'max_ms' : 1000 * lS[-1] if lS else 0.0,
+        }
+
+def StrGitRev():
+    try:
+        return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=enginebench.s_pathRoot,
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def DRun(args):
+    pathData = enginebench.PathDataTemp()
+    proc = enginebench.ProcServerStart(args.engine, args.port, pathData, shlex.split(args.server_args))
+    try:
+        # players are dealt out round robin, so every client has about the same amount of work
+
+        llIPlayer = [list(range(iClient, args.players, args.clients)) for iClient in range(args.clients)]
+        strTag = 'p{s}x'.format(s=args.seed)
+
+        queue = multiprocessing.Queue()
+        lProc = [multiprocessing.Process(target=RunClient, args=(args.port, lIPlayer, args.moves, args.seed, strTag, queue))
+                 for lIPlayer in llIPlayer]
+
+        sStart = time.perf_counter()
+        for procClient in lProc:
+            procClient.start()
+        lResult = [queue.get() for _ in lProc]
+        sWall = time.perf_counter() - sStart
+
+        for procClient in lProc:
+            procClient.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(pathData, ignore_errors=True)
+
+    mpRouteD = {}
+    for strRoute in s_lStrRoute:
+        lS = [s for mpRouteLS, _ in lResult for s in mpRouteLS[strRoute]]
+        cErr = sum(mpRouteCErr[strRoute] for _, mpRouteCErr in lResult)
+        mpRouteD[strRoute] = DRouteStats(lS, cErr, sWall)
+
+    return {
+            'version' : 1,
+            'git' : StrGitRev(),
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config' : {
+                    'engine' : args.engine,
+                    'server_args' : args.server_args,
+                    'players' : args.players,
+                    'clients' : args.clients,
+                    'moves' : args.moves,
+                    'seed' : args.seed,
+                },
+            'wall_s' : sWall,
+            'routes' : mpRouteD,
+        }
+
+def PrintResult(d, dPrev):
+    print("{p} players x {m} moves, {c} clients, {e} engine, seed {s}: {w:.2f}s".format(
+            p=d['config']['players'], m=d['config']['moves'], c=d['config']['clients'],
+            e=d['config']['engine'], s=d['config']['seed'], w=d['wall_s']))
+    print("  {r:<8} {n:>7} {x:>6} {q:>9} {a:>8} {b:>8} {c:>8}".format(
+            r='route', n='count', x='errors', q='req/s', a='p50 ms', b='p95 ms', c='p99 ms'))
+
+    for strRoute, dRoute in d['routes'].items():
+        print("  {r:<8} {n:>7} {x:>6} {q:>9.1f} {a:>8.2f} {b:>8.2f} {c:>8.2f}".format(
+                r=strRoute, n=dRoute['count'], x=dRoute['errors'], q=dRoute['rps'],
+                a=dRoute['p50_ms'], b=dRoute['p95_ms'], c=dRoute['p99_ms']))
+
+        dRoutePrev = dPrev['routes'].get(strRoute) if dPrev else None
+        if dRoutePrev:
+            lStr = []
+            for strKey in ('p50_ms', 'p95_ms', 'p99_ms'):
+                if dRoutePrev[strKey]:
+                    lStr.append("{k} {x:+.0%}".format(k=strKey[:3], x=dRoute[strKey] / dRoutePrev[strKey] - 1))
+            print("  {r:<8} vs {g}: {l}".format(r='', g=dPrev.get('git') or 'baseline', l=', '.join(lStr)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate players against a local server and report per-route latency")
+    parser.add_argument('--players', default=64, type=int, help="Players to simulate in total")
+    parser.add_argument('--clients', default=4, type=int, help="Client processes the players are spread over")
+    parser.add_argument('--moves', default=50, type=int, help="Room moves per player")
+    parser.add_argument('--seed', default=1, type=int, help="Seed for the players' walks")
+    parser.add_argument('--engine', default='threading', choices=['threading', 'asyncio'])
+    parser.add_argument('--server-args', default='--hash-workers 0', help="Extra arguments for main.py")
+    parser.add_argument('--port', default=8125, type=int, help="Port to run the server on")
+    parser.add_argument('--out', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    dPrev = None
+    if args.compare:
+        with open(args.compare) as fileIn:
+            dPrev = json.load(fileIn)
+
+    d = DRun(args)
+    PrintResult(d, dPrev)
+
+    if args.out:
+        with open(args.out, 'w') as fileOut:
+            json.dump(d, fileOut, indent=2)
@@ -0,0 +1,84 @@
+# microbenchmark: layout startup from game.yml vs. from a compiled game pack
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gamepack
+import layout
+
+def WriteLayout(path, cRoom, rng):
+    """A synthetic world of cRoom rooms, each with a few (sometimes conditional) exits"""
+
+    lDoc = []
+    for iRoom in range(cRoom):
+        lExit = []
+        for _ in range(rng.randint(1, 4)):
+            iDest = rng.randrange(cRoom)
+            exit = {'name' : 'Room {i}'.format(i=iDest), 'verb' : 'Go to room {i}'.format(i=iDest)}
+            if rng.random() < 0.3:
+                exit['cond'] = {'or' : [['gt', 'keys', rng.randint(0, 5)], ['eq', 'visited', 1]]}
+            lExit.append(exit)
+        lDoc.append({
+                'name' : 'Room {i}'.format(i=iRoom),
+                'desc' : 'Room number {i}. You are carrying {{keys}} keys.'.format(i=iRoom),
+                'exits' : lExit,
+                'changes' : [['add', 'steps', 1]],
+            })
+
+    with open(path, 'w') as fileOut:
+        yaml.safe_dump_all(lDoc, fileOut)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare layout startup from yaml and from a game pack")
+    parser.add_argument('--rooms', default=20000, type=int, help="Rooms in the synthetic layout")
+    parser.add_argument('--touch', default=100, type=int, help="Rooms to look up after a pack load")
+    parser.add_argument('--seed', default=1, type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as pathDir:
+        pathYaml = os.path.join(pathDir, 'game.yml')
+        pathPack = os.path.join(pathDir, 'game.pack')
+        WriteLayout(pathYaml, args.rooms, rng)
+
+        sStart = time.perf_counter()
+        rooms = layout.Rooms()
+        rooms.Load(pathYaml)
+        sYaml = time.perf_counter() - sStart
+
+        sStart = time.perf_counter()
+        gamepack.Compile(pathYaml, pathPack)
+        sCompile = time.perf_counter() - sStart
+
+        sStart = time.perf_counter()
+        pack = gamepack.PackOpen(pathPack, pathYaml)
+        roomsPack = layout.Rooms()
+        roomsPack.LoadPack(pack)
+        sPack = time.perf_counter() - sStart
+
+        # the pack has to agree with the yaml on every room it hands out
+
+        sStart = time.perf_counter()
+        for _ in range(args.touch):
+            name = 'Room {i}'.format(i=rng.randrange(args.rooms))
+            room = rooms.Room(name)
+            roomPack = roomsPack.Room(name)
+            assert room.m_abPageHead == roomPack.m_abPageHead
+            assert [exit.m_idDest for exit in room.m_lExitPage] == [exit.m_idDest for exit in roomPack.m_lExitPage]
+        sTouch = time.perf_counter() - sStart
+
+        pack.Close()
+
+    print("{c} rooms".format(c=args.rooms))
+    print("  yaml load   {s:8.3f}s".format(s=sYaml))
+    print("  compile     {s:8.3f}s".format(s=sCompile))
+    print("  pack load   {s:8.3f}s  {x:.0f}x faster".format(s=sPack, x=sYaml / sPack))
+    print("  {t} lookups {s:8.3f}s (both layouts)".format(t=args.touch, s=sTouch))
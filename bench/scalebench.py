@@ -0,0 +1,109 @@
+# scaling benchmark: room moves per second vs. number of pre-forked workers (main.py --workers)
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import enginebench
+
+s_reSid = re.compile(r'name="sid" id="sid" value="([0-9a-f]+)"')
+
+def CMoveClient(port, iClient, sDuration, queue):
+    """Client worker: create a player, then walk back and forth between two rooms for sDuration
+    seconds on one keep-alive connection, reporting the number of moves completed"""
+
+    uid = 'bench{i}'.format(i=iClient)
+    strBody = 'login={u}&pass=benchpass&pass2=benchpass'.format(u=uid)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('POST', '/create', body=strBody, headers={'Content-Type' : 'application/x-www-form-urlencoded'})
+    resp = conn.getresponse()
+    match = s_reSid.search(resp.read().decode())
+    conn.close()
+    if match is None:
+        queue.put((0, 1))
+        return
+
+    sid = match.group(1)
+    lStrBody = ['sid={s}&dest={d}'.format(s=sid, d=dest) for dest in ('Left+Room', 'Starting+Room')]
+
+    cReq = 0
+    cErr = 0
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    sEnd = time.perf_counter() + sDuration
+
+    while time.perf_counter() < sEnd:
+        try:
+            conn.request('POST', '/room', body=lStrBody[cReq % 2])
+            resp = conn.getresponse()
+            abPage = resp.read()
+            if resp.status == 200 and b'<title>Oops' not in abPage:
+                cReq += 1
+            else:
+                cErr += 1
+        except (OSError, http.client.HTTPException):
+            cErr += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+
+    conn.close()
+    queue.put((cReq, cErr))
+
+def DRun(cWorker, strEngine, port, cClient, sDuration):
+    pathData = enginebench.PathDataTemp()
+    proc = enginebench.ProcServerStart(strEngine, port, pathData, [
+            '--workers', str(cWorker),
+            '--store', 'sqlite',
+            '--hash-workers', '0',
+        ])
+    try:
+        queue = multiprocessing.Queue()
+        lProc = [multiprocessing.Process(target=CMoveClient, args=(port, iClient, sDuration, queue))
+                 for iClient in range(cClient)]
+        for procClient in lProc:
+            procClient.start()
+        lResult = [queue.get() for _ in lProc]
+        for procClient in lProc:
+            procClient.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(pathData, ignore_errors=True)
+
+    cReq = sum(x[0] for x in lResult)
+    cErr = sum(x[1] for x in lResult)
+
+    return {
+            'workers' : cWorker,
+            'requests' : cReq,
+            'errors' : cErr,
+            'rps' : cReq / sDuration,
+        }
+
+if __name__ == '__main__':
+    cCpu = os.cpu_count() or 1
+    lCWorkerDefault = sorted({1, 2, 4, cCpu} & set(range(1, cCpu + 1)))
+
+    parser = argparse.ArgumentParser(description="Measure room moves per second against the number of workers")
+    parser.add_argument('--workers', default=lCWorkerDefault, type=int, nargs='+', help="Worker counts to try")
+    parser.add_argument('--engine', default='threading', choices=['threading', 'asyncio'])
+    parser.add_argument('--clients', default=2 * cCpu, type=int, help="Number of concurrent client processes")
+    parser.add_argument('--seconds', default=5.0, type=float, help="Duration of each run")
+    parser.add_argument('--port', default=8124, type=int, help="Port to run the server on")
+    args = parser.parse_args()
+
+    print("{c} clients, {s}s per run, POST /room, {e} engine, {n} cores".format(
+            c=args.clients, s=args.seconds, e=args.engine, n=cCpu))
+
+    rpsBase = None
+    for cWorker in args.workers:
+        d = DRun(cWorker, args.engine, args.port, args.clients, args.seconds)
+        rpsBase = rpsBase or d['rps']
+        print("  workers={w:<3} {r:>9.1f} req/s  {x:5.2f}x  ({n} ok, {e} errors)".format(
+                w=d['workers'], r=d['rps'], x=d['rps'] / rpsBase if rpsBase else 0, n=d['requests'], e=d['errors']))
@@ -0,0 +1,248 @@
+# concurrency stress test: many threads driving one player's session (as if from many tabs), then
+#  checks that no change was lost, every page showed one consistent state, and the saved session
+#  matches memory; also races several creates of the same user. Then the same again in shared mode
+#  (as with main.py --workers): two servers in this process, each with its own connections to one
+#  sessions.db, standing in for two worker processes
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import enginebench
+
+sys.path.insert(0, enginebench.s_pathRoot)
+
+import contentcoding
+import gamepack
+import server
+import session
+import store
+
+s_reSid = re.compile(r'name="sid" id="sid" value="([0-9a-f]+)"')
+s_reRight = re.compile(r'It has (\d+) monsters in it,\s+each of whom are carrying (\d+) fleas')
+
+class HandlerStub:
+    """Just enough of Hs.BaseHTTPRequestHandler for the Server.On* routes; keeps the pages sent and
+    notes whether the last move made was into the Right Room (a shared mode request may make its
+    move several times, but only the last one counts)"""
+
+    def __init__(self):
+        self.headers = {}
+        self.m_code = None
+        self.m_lAbPage = []
+        self.m_fEnterRight = False
+        self.m_lStrErr = []
+
+    def send_response(self, code, message=None):
+        self.m_code = code
+
+    def send_header(self, keyword, value):
+        pass
+
+    def end_headers(self):
+        pass
+
+    def EndHeadersWithBody(self, abBody):
+        self.m_lAbPage.append(bytes(abBody))
+
+    def log_message(self, format, *args):
+        strMsg = format % args
+        if strMsg.startswith('Moving from'):
+            self.m_fEnterRight = strMsg.endswith("to 'Right Room' (valid)")
+
+    def log_error(self, format, *args):
+        self.m_lStrErr.append(format % args)
+
+def ServerCreate(pathData, fShared=False):
+    """A server for the data in pathData; fShared sets it up like one of main.py's --workers"""
+
+    os.chdir(pathData)
+
+    rooms = gamepack.RoomsLoad('game.yml', 'game.pack')
+    group = session.Group()
+    if fShared:
+        group.SetStore(store.SqliteStore('sessions.db', cSaveBatch=1))
+        group.SetShared()
+    group.Load('sessions')
+    group.InitRooms(rooms)
+
+    serverMain = server.Server()
+    serverMain.SetRooms(rooms)
+    if fShared:
+        serverMain.SetSidRegistry(server.SharedSidRegistry('sessions.db', group))
+    serverMain.SetGroup(group)
+    return serverMain
+
+def LStrCheckCreateRace(serverMain, cThread):
+    """Create the same user from cThread threads at once; exactly one may succeed"""
+
+    lHandler = [HandlerStub() for _ in range(cThread)]
+    dPost = {'login' : 'racer', 'pass' : 'racerpass', 'pass2' : 'racerpass'}
+    lThread = [threading.Thread(target=serverMain.OnPostCreate, args=(handler, dict(dPost))) for handler in lHandler]
+    for thread in lThread:
+        thread.start()
+    for thread in lThread:
+        thread.join()
+
+    cCreated = sum(1 for handler in lHandler if b'Login Successful' in handler.m_lAbPage[-1])
+    if cCreated != 1:
+        return ["{c} of {n} concurrent creates of one user succeeded".format(c=cCreated, n=cThread)]
+    return []
+
+class Mover:
+    """Bounces one player between the Garage and the Right Room, counting the entries into the
+    Right Room that were committed (and so shown)"""
+
+    def __init__(self, serverMain, sid, cMove):
+        self.m_serverMain = serverMain
+        self.m_sid = sid
+        self.m_cMove = cMove
+        self.m_handler = HandlerStub()
+        self.m_cEnterRight = 0
+        self.m_cBusy = 0
+        self.m_exc = None
+
+    def Run(self):
+        try:
+            for iMove in range(self.m_cMove):
+                strDest = 'The Garage' if iMove % 2 == 0 else 'Right Room'
+                self.m_handler.m_fEnterRight = False
+                self.m_serverMain.OnPostRoom(self.m_handler, {'sid' : self.m_sid, 'dest' : strDest})
+                if self.m_handler.m_code == 503:
+                    self.m_cBusy += 1
+                elif self.m_handler.m_fEnterRight:
+                    self.m_cEnterRight += 1
+        except Exception as exc:
+            self.m_exc = exc
+
+def LStrRunMovers(lServer, sid, cThread, cMove):
+    """Run cThread movers on one session (spread over the servers in lServer); returns the movers
+    and a list of problems found"""
+
+    lMover = [Mover(lServer[iThread % len(lServer)], sid, cMove) for iThread in range(cThread)]
+    lThread = [threading.Thread(target=mover.Run) for mover in lMover]
+    for thread in lThread:
+        thread.start()
+    for thread in lThread:
+        thread.join()
+
+    lStr = ["mover raised {e!r}".format(e=mover.m_exc) for mover in lMover if mover.m_exc is not None]
+
+    # every page must have been rendered from one state: never between the two adds
+
+    for mover in lMover:
+        for abPage in mover.m_handler.m_lAbPage:
+            match = s_reRight.search(abPage.decode())
+            if match is not None and 7 * int(match.group(1)) != 2 * int(match.group(2)):
+                lStr.append("torn page: {m} monsters with {f} fleas".format(m=match.group(1), f=match.group(2)))
+                break
+
+    return lMover, lStr
+
+def LStrCheckCounts(cEnterRight, mpVarVal, strWhere):
+    """Each committed move into the Right Room adds 2 monsters and 7 fleas"""
+
+    cMonster = mpVarVal.get('monsters') or 0
+    cFlea = mpVarVal.get('fleas') or 0
+    if cMonster != 2 * cEnterRight or cFlea != 7 * cEnterRight:
+        return ["{e} entries into the Right Room, but {m} monsters and {f} fleas {w} (lost updates)".format(
+                e=cEnterRight, m=cMonster, f=cFlea, w=strWhere)]
+    return []
+
+def LStrCheckMoves(serverMain, cThread, cMove):
+    """Run cThread movers on one session; returns a list of problems found"""
+
+    sessionPlayer = serverMain.m_group.SessionCreate()
+    sessionPlayer.SetCreds('stress', 'stresspass')
+    sessionPlayer.SetPath(os.path.join('sessions', 'stress.session'))
+    sessionPlayer.SetRoomCur(serverMain.m_rooms.Room('Right Room'))
+    serverMain.m_group.FAddSession(sessionPlayer)
+    sessionPlayer.Save()
+    sid = serverMain.SidGenerate(sessionPlayer)
+
+    lMover, lStr = LStrRunMovers([serverMain], sid, cThread, cMove)
+
+    cEnterRight = sum(mover.m_cEnterRight for mover in lMover)
+    lStr += LStrCheckCounts(cEnterRight, sessionPlayer.m_mpVarVal, "in memory")
+
+    # what's on disk is the latest state, and no save left its temporary files behind
+
+    try:
+        docDisk = session.DocLoadPath(sessionPlayer.m_path)
+    except OSError as err:
+        docDisk = None
+        lStr.append("saved session is missing: {e}".format(e=err))
+
+    if docDisk is not None and docDisk != sessionPlayer.DDoc():
+        lStr.append("saved session {d} doesn't match memory {m}".format(d=docDisk, m=sessionPlayer.DDoc()))
+    for strExt in ('.new', '.old'):
+        if os.path.exists(sessionPlayer.m_path + strExt):
+            lStr.append("left behind {p}".format(p=sessionPlayer.m_path + strExt))
+
+    print("  {t} threads x {m} moves: {e} accepted entries into the Right Room".format(
+            t=cThread, m=cMove, e=cEnterRight))
+
+    return lStr
+
+def LStrCheckMovesShared(lServer, cThread, cMove):
+    """Run cThread movers on one session, alternating between the (shared mode) servers in lServer,
+    so each request reads and saves its own copy; returns a list of problems found"""
+
+    serverFirst = lServer[0]
+    sessionPlayer = serverFirst.m_group.SessionCreate()
+    sessionPlayer.SetCreds('stress', 'stresspass')
+    sessionPlayer.SetRoomCur(serverFirst.m_rooms.Room('Right Room'))
+    serverFirst.m_group.FAddSession(sessionPlayer)
+    sid = serverFirst.SidGenerate(sessionPlayer)
+
+    lMover, lStr = LStrRunMovers(lServer, sid, cThread, cMove)
+
+    cEnterRight = sum(mover.m_cEnterRight for mover in lMover)
+    doc = serverFirst.m_group.m_store.DocFromUid('stress')
+    lStr += LStrCheckCounts(cEnterRight, doc['vars'], "in the store")
+
+    print("  shared, {s} servers, {t} threads x {m} moves: {e} committed entries into the Right Room, {b} gave up busy".format(
+            s=len(lServer), t=cThread, m=cMove, e=cEnterRight, b=sum(mover.m_cBusy for mover in lMover)))
+
+    return lStr
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hammer one session from many threads and check its state stays consistent")
+    parser.add_argument('--threads', default=16, type=int, help="Threads driving the session")
+    parser.add_argument('--moves', default=500, type=int, help="Moves per thread")
+    parser.add_argument('--switch-interval', default=1e-6, type=float, metavar='SECONDS',
+                        help="sys.setswitchinterval while running, small to make races likely")
+    args = parser.parse_args()
+
+    # the stub handler can't take compressed output apart, and doesn't need to
+
+    contentcoding.g_coder.Configure(0, 0)
+    sys.setswitchinterval(args.switch_interval)
+
+    pathData = enginebench.PathDataTemp()
+    pathDataShared = enginebench.PathDataTemp()
+    lServerShared = []
+    try:
+        serverMain = ServerCreate(pathData)
+        lStrProblem = LStrCheckCreateRace(serverMain, args.threads)
+        lStrProblem += LStrCheckMoves(serverMain, args.threads, args.moves)
+
+        lServerShared = [ServerCreate(pathDataShared, fShared=True) for _ in range(2)]
+        lStrProblem += LStrCheckCreateRace(lServerShared[0], args.threads)
+        lStrProblem += LStrCheckMovesShared(lServerShared, args.threads, args.moves)
+    finally:
+        for serverShared in lServerShared:
+            serverShared.m_group.Shutdown()
+        os.chdir(enginebench.s_pathRoot)
+        shutil.rmtree(pathData, ignore_errors=True)
+        shutil.rmtree(pathDataShared, ignore_errors=True)
+
+    for strProblem in lStrProblem:
+        print("  FAIL: " + strProblem)
+    print("  {r}".format(r='FAILED' if lStrProblem else 'ok'))
+    sys.exit(1 if lStrProblem else 0)
@@ -0,0 +1,150 @@
+# response writing: content coding negotiation (gzip/deflate), precompressed static pages, and
+#  complete (length-prefixed, single send) responses for every route
+
+import metrics
+import tracing
+import zlib
+
+# preferred first, when the client accepts several equally
+
+s_lStrCoding = ['gzip', 'deflate']
+
+def StrCodingNegotiate(strAcceptEncoding):
+    """The coding (from s_lStrCoding) to use for a client sending this Accept-Encoding header, or
+    None to send the body as is"""
+
+    if not strAcceptEncoding:
+        return None
+
+    mpStrCodingQ = {}
+    for strPart in strAcceptEncoding.split(','):
+        strCoding, _, strParams = strPart.partition(';')
+        strCoding = strCoding.strip().lower()
+        q = 1.0
+        strParams = strParams.strip()
+        if strParams.startswith('q='):
+            try:
+                q = float(strParams[2:])
+            except ValueError:
+                q = 0.0
+        mpStrCodingQ[strCoding] = q
+
+    qStar = mpStrCodingQ.get('*', 0.0)
+    strBest = None
+    qBest = 0.0
+    for strCoding in s_lStrCoding:
+        q = mpStrCodingQ.get(strCoding, qStar)
+        if q > qBest:
+            strBest = strCoding
+            qBest = q
+
+    return strBest
+
+def AbCompress(ab, strCoding, level):
+    """ab encoded with strCoding. HTTP's deflate is the zlib format; gzip gets a header with no
+    file name or timestamp, so the same input always compresses to the same bytes."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31 if strCoding == 'gzip' else 15)
+    return compressor.compress(ab) + compressor.flush()
+
+class StaticPage:
+    """A page that is the same for every request, kept encoded and compressed (each coding) ahead
+    of time"""
+
+    def __init__(self, ab, level, cBMin):
+        self.m_ab = ab
+        self.m_mpStrCodingAb = {}
+        if level > 0 and len(ab) >= cBMin:
+            for strCoding in s_lStrCoding:
+                abCoded = AbCompress(ab, strCoding, level)
+                if len(abCoded) < len(ab):
+                    self.m_mpStrCodingAb[strCoding] = abCoded
+
+class Coder:
+    """Sends complete responses for the Server.On* routes, with the body compressed if the client
+    accepts it and it's big enough to be worth it (cBMin bytes). Level 0 turns compression off."""
+
+    s_level = 6
+    s_cBMin = 512
+
+    def __init__(self):
+        self.m_level = self.s_level
+        self.m_cBMin = self.s_cBMin
+
+    def Configure(self, level, cBMin):
+        """Set compression level (0-9) and threshold; pages made by PageStatic before this keep
+        the settings they were made with"""
+
+        self.m_level = level
+        self.m_cBMin = cBMin
+
+    def PageStatic(self, ab):
+        return StaticPage(ab, self.m_level, self.m_cBMin)
+
+    def Send(self, handler, code, body, lPairHeader=(), strContentType='text/html; charset=utf-8', fCompress=True):
+        """Send a complete response: status code, the (name, value) headers in lPairHeader, and body
+        (bytes or a StaticPage), negotiating the content coding with the client unless fCompress is
+        False. Headers and body go out in one send, and always with a Content-Length so the
+        connection can be reused. A body of None is for replies that have none at all (304)."""
+
+        if body is None:
+            handler.send_response(code)
+            for strName, value in lPairHeader:
+                handler.send_header(strName, value)
+            handler.end_headers()
+            return
+
+        strCoding = None
+        if isinstance(body, StaticPage):
+            fVaries = bool(body.m_mpStrCodingAb)
+            if fVaries:
+                strCoding = StrCodingNegotiate(handler.headers.get('Accept-Encoding'))
+            abOut = body.m_mpStrCodingAb.get(strCoding) if strCoding else None
+            if abOut is None:
+                strCoding = None
+                abOut = body.m_ab
+        else:
+            fVaries = fCompress and self.m_level > 0 and len(body) >= self.m_cBMin
+            if fVaries:
+                strCoding = StrCodingNegotiate(handler.headers.get('Accept-Encoding'))
+            if strCoding is not None:
+                with tracing.g_tracer.Span('compress'):
+                    abOut = AbCompress(body, strCoding, self.m_level)
+            else:
+                abOut = body
+
+        handler.send_response(code)
+        handler.send_header('Content-Type', strContentType)
+        for strName, value in lPairHeader:
+            handler.send_header(strName, value)
+
+        # caches must know that the body depends on Accept-Encoding whenever it could have
+
+        if fVaries:
+            handler.send_header('Vary', 'Accept-Encoding')
+        if strCoding is not None:
+            handler.send_header('Content-Encoding', strCoding)
+
+        handler.send_header('Content-Length', len(abOut))
+        handler.EndHeadersWithBody(abOut)
+
+        metrics.g_metrics.Count('webadv_body_bytes_total', s_mpStrCodingLabels[strCoding], len(abOut))
+
+    def SendFile(self, handler, code, fileIn, iBStart, cB, lPairHeader=(), strContentType='application/octet-stream'):
+        """Send a response whose body is cB bytes of fileIn from iBStart, streamed from the file
+        (never content coded) after the headers. Takes ownership of fileIn."""
+
+        handler.send_response(code)
+        handler.send_header('Content-Type', strContentType)
+        for strName, value in lPairHeader:
+            handler.send_header(strName, value)
+        handler.send_header('Content-Length', cB)
+        handler.end_headers()
+        handler.SendFile(fileIn, iBStart, cB)
+
+s_mpStrCodingLabels = {strCoding : 'coding="{c}"'.format(c=strCoding) for strCoding in s_lStrCoding}
+s_mpStrCodingLabels[None] = 'coding="identity"'
+
+metrics.g_metrics.Describe('webadv_body_bytes_total', 'counter', "Response body bytes sent from memory (pages, cached images), by content coding")
+
+g_coder = Coder()
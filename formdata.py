@@ -0,0 +1,97 @@
+# POST bodies (application/x-www-form-urlencoded): bounded, incremental reads and one decoding pass
+
+import time
+import urllib.parse
+
+class FormError(Exception):
+    """A POST body we won't process; m_code is the HTTP status to answer with"""
+
+    def __init__(self, code, strMsg):
+        super().__init__(strMsg)
+        self.m_code = code
+
+s_strContentTypeForm = 'application/x-www-form-urlencoded'
+s_cBChunk = 16 * 1024
+s_cFieldMax = 64
+
+def DPostRead(handler, cBMax, sTimeout):
+    """Read handler's POST body and decode it into a dict of field -> value (the last one wins for
+    repeated fields). Raises FormError for anything malformed, too big (more than cBMax bytes), or
+    too slow to arrive (more than sTimeout seconds); what the headers alone give away is rejected
+    before any of the body is read."""
+
+    headers = handler.headers
+
+    if headers.get('Transfer-Encoding'):
+        raise FormError(411, "Bodies must be sent with a Content-Length")
+
+    strCl = headers.get('Content-Length')
+    if strCl is None:
+        return {}
+
+    try:
+        cB = int(strCl)
+    except ValueError:
+        raise FormError(400, "Bad Content-Length {s!r}".format(s=strCl))
+
+    if cB < 0:
+        raise FormError(400, "Bad Content-Length {s!r}".format(s=strCl))
+
+    if cB > cBMax:
+        raise FormError(413, "Body of {c} bytes is over the {m} byte limit".format(c=cB, m=cBMax))
+
+    # no Content-Type at all is taken to be a form, as it's what simple clients leave off
+
+    strType = headers.get('Content-Type', s_strContentTypeForm).partition(';')[0].strip().lower()
+    if strType != s_strContentTypeForm:
+        raise FormError(415, "Unsupported Content-Type {s!r}".format(s=strType))
+
+    abPost = AbRead(handler, cB, time.monotonic() + sTimeout)
+
+    # percent escapes and '+' are undone here, once, for every field
+
+    try:
+        lPair = urllib.parse.parse_qsl(
+                abPost.decode('utf-8'), keep_blank_values=True, encoding='utf-8', errors='strict',
+                max_num_fields=s_cFieldMax)
+    except ValueError as err:
+        # includes UnicodeDecodeError, and more than s_cFieldMax fields
+        raise FormError(400, "Malformed form data: {e}".format(e=err))
+
+    return dict(lPair)
+
+def AbRead(handler, cB, sDeadline):
+    """cB bytes of handler's request body, read a chunk at a time so a slow client can't hold the
+    thread past sDeadline (time.monotonic)"""
+
+    # the threading engine reads straight from the socket; the asyncio engine has already buffered
+    #  the body (under its own timeout), so there it's just a copy
+
+    conn = getattr(handler, 'connection', None)
+    sTimeoutPrev = conn.gettimeout() if conn is not None else None
+
+    lAb = []
+    cBLeft = cB
+    try:
+        while cBLeft > 0:
+            sLeft = sDeadline - time.monotonic()
+            if sLeft <= 0:
+                raise FormError(408, "Body took too long to arrive")
+            if conn is not None:
+                conn.settimeout(sLeft)
+
+            try:
+                ab = handler.rfile.read1(min(cBLeft, s_cBChunk))
+            except TimeoutError:
+                raise FormError(408, "Body took too long to arrive")
+
+            if not ab:
+                raise FormError(400, "Body ended {c} bytes short".format(c=cBLeft))
+
+            lAb.append(ab)
+            cBLeft -= len(ab)
+    finally:
+        if conn is not None:
+            conn.settimeout(sTimeoutPrev)
+
+    return b''.join(lAb)
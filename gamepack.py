@@ -0,0 +1,183 @@
+# precompiled game packs: game.yml validated once and stored in a form that loads without yaml
+
+import argparse
+import hashlib
+import layout
+import marshal
+import mmap
+import os
+import struct
+import yaml
+
+try:
+    LoaderYaml = yaml.CSafeLoader
+except AttributeError:
+    LoaderYaml = yaml.SafeLoader
+
+# Pack layout: a fixed header, the index, then one marshaled room doc per room. The header records
+#  the size, mtime and hash of the game.yml the pack was compiled from, so a stale pack is never used.
+
+s_abMagic = b'WADVPACK'
+s_nVersion = 1
+s_structHeader = struct.Struct('<8sII32sqqQ')
+
+def AbHashPath(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fileIn:
+        for aB in iter(lambda: fileIn.read(1024 * 1024), b''):
+            hasher.update(aB)
+    return hasher.digest()
+
+class Pack:
+    """An open game pack. The index (room names, exit destinations, load report) is read up front;
+    room docs stay in the mapped file until DocFromId asks for one."""
+
+    def __init__(self, path):
+        self.m_path = path
+        self.m_fileIn = open(path, 'rb')
+        self.m_mmap = mmap.mmap(self.m_fileIn.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (abMagic, nVersion, nMarshal, self.m_abHashSource,
+         self.m_cBSource, self.m_nsMtimeSource, cBIndex) = s_structHeader.unpack_from(self.m_mmap, 0)
+
+        if abMagic != s_abMagic or nVersion != s_nVersion or nMarshal != marshal.version:
+            self.Close()
+            raise ValueError("{p} is not a version {v} game pack".format(p=path, v=s_nVersion))
+
+        iBIndex = s_structHeader.size
+        index = marshal.loads(self.m_mmap[iBIndex:iBIndex + cBIndex])
+
+        self.m_iBRooms = iBIndex + cBIndex
+        self.m_lName = index['names']
+        self.m_lIBSpan = index['spans']         # offset, size pairs, flattened
+        self.m_llIdDest = index['dests']        # per room, the destination id (or None) of each page exit
+        self.m_lStrErr = index['errors']        # rooms dropped when compiling, as Rooms.Load would report them
+        self.m_lStrBroken = index['broken']
+        self.m_lNameUnreachable = index['unreachable']
+
+    def FIsCurrent(self, pathSource):
+        """True if the pack was compiled from the current contents of pathSource"""
+
+        try:
+            stat = os.stat(pathSource)
+        except OSError:
+            return False
+
+        if stat.st_size != self.m_cBSource:
+            return False
+
+        # an untouched file can skip the hash; a touched one may still have the same contents
+
+        if stat.st_mtime_ns == self.m_nsMtimeSource:
+            return True
+
+        return AbHashPath(pathSource) == self.m_abHashSource
+
+    def DocFromId(self, idRoom):
+        iB = self.m_iBRooms + self.m_lIBSpan[2 * idRoom]
+        return marshal.loads(self.m_mmap[iB:iB + self.m_lIBSpan[2 * idRoom + 1]])
+
+    def Close(self):
+        self.m_mmap.close()
+        self.m_fileIn.close()
+
+def PackOpen(pathPack, pathSource):
+    """Returns the Pack at pathPack if there is one and it is current for pathSource, else None"""
+
+    if not os.path.exists(pathPack):
+        return None
+
+    try:
+        pack = Pack(pathPack)
+    except (OSError, ValueError, EOFError, struct.error) as exc:
+        print("Ignoring game pack {p}: {e}".format(p=pathPack, e=exc))
+        return None
+
+    if not pack.FIsCurrent(pathSource):
+        print("Ignoring game pack {p}: {s} has changed since it was compiled".format(p=pathPack, s=pathSource))
+        pack.Close()
+        return None
+
+    return pack
+
+def RoomsLoad(pathSource, pathPack):
+    """Load the layout from pathPack if it is current for pathSource, otherwise from pathSource itself"""
+
+    rooms = layout.Rooms()
+    pack = PackOpen(pathPack, pathSource)
+    if pack is not None:
+        rooms.LoadPack(pack)
+    else:
+        rooms.Load(pathSource)
+
+    return rooms
+
+def Compile(pathSource, pathPack):
+    """Validate the layout in pathSource and write it to pathPack. Returns the Rooms it loaded, so
+    the caller can report on it."""
+
+    # the yaml is hashed before it's parsed, so an edit that lands mid-compile makes the pack stale
+    #  rather than silently wrong
+
+    stat = os.stat(pathSource)
+    abHash = AbHashPath(pathSource)
+
+    rooms = layout.Rooms()
+    rooms.m_strGen = layout.StrGenFromHash(abHash)
+    lDoc = []
+    lStrErr = []
+    with open(pathSource, 'r') as fileIn:
+        for doc in yaml.load_all(fileIn, Loader=LoaderYaml):
+            strErr = rooms.StrAddDoc(doc)
+            if strErr:
+                lStrErr.append(strErr)
+            elif doc is not None:
+                lDoc.append(doc)
+
+    rooms.LinkExits()
+
+    lAbRoom = [marshal.dumps(doc) for doc in lDoc]
+    lIBSpan = []
+    iB = 0
+    for abRoom in lAbRoom:
+        lIBSpan.extend((iB, len(abRoom)))
+        iB += len(abRoom)
+
+    abIndex = marshal.dumps({
+            'names' : [room.m_name for room in rooms.m_lRoom],
+            'spans' : lIBSpan,
+            'dests' : [[exit.m_idDest for exit in room.m_lExitPage] for room in rooms.m_lRoom],
+            'errors' : lStrErr,
+            'broken' : rooms.m_lStrBroken,
+            'unreachable' : rooms.m_lNameUnreachable,
+        })
+
+    abHeader = s_structHeader.pack(
+            s_abMagic, s_nVersion, marshal.version, abHash, stat.st_size, stat.st_mtime_ns, len(abIndex))
+
+    # write and rename, so a running server never maps a half written pack
+
+    tmp = pathPack + '.new'
+    with open(tmp, 'wb') as fileOut:
+        fileOut.write(abHeader)
+        fileOut.write(abIndex)
+        for abRoom in lAbRoom:
+            fileOut.write(abRoom)
+    os.replace(tmp, pathPack)
+
+    for strErr in lStrErr:
+        print(strErr)
+
+    return rooms
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile a game layout into a game pack")
+    parser.add_argument('source', nargs='?', default='game.yml', help="Layout to compile")
+    parser.add_argument('pack', nargs='?', default='game.pack', help="Pack to write")
+    args = parser.parse_args()
+
+    rooms = Compile(args.source, args.pack)
+    strReport = rooms.StrGraphReport()
+    if strReport:
+        print(strReport)
+    print("Compiled {c} rooms from {s} into {p}".format(c=len(rooms.m_lRoom), s=args.source, p=args.pack))
@@ -0,0 +1,94 @@
+# reloading game.yml into a running server
+
+import gamepack
+import hashlib
+import layout
+import os
+import signal
+import threading
+
+class LayoutWatcher:
+    """Reloads the layout when game.yml changes (polled every sInterval seconds, if given) or when
+    asked to (SIGHUP). The new Rooms is built and checked off to the side, then swapped in for the
+    server and every loaded session; a layout with broken exits is reported and left out."""
+
+    def __init__(self, server, group, pathSource, pathPack, sInterval):
+        self.m_server = server
+        self.m_group = group
+        self.m_pathSource = pathSource
+        self.m_pathPack = pathPack
+        self.m_sInterval = sInterval
+        self.m_statSource = self.StatSource()
+        self.m_cReload = 0
+        self.m_eventReload = threading.Event()
+        self.m_thread = None
+
+    def StatSource(self):
+        try:
+            stat = os.stat(self.m_pathSource)
+        except OSError:
+            return None
+
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def Start(self):
+        # the handler only wakes the watcher thread; loading never happens inside a signal handler
+
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.m_eventReload.set())
+
+        self.m_thread = threading.Thread(target=self.RunThread, name='layout-watcher', daemon=True)
+        self.m_thread.start()
+
+    def RunThread(self):
+        while True:
+            fAsked = self.m_eventReload.wait(self.m_sInterval if self.m_sInterval > 0 else None)
+            self.m_eventReload.clear()
+
+            statSource = self.StatSource()
+            if not fAsked and statSource == self.m_statSource:
+                continue
+
+            self.m_statSource = statSource
+
+            try:
+                self.Reload()
+            except Exception as exc:
+                # a bad edit must never take the server down; the old layout just stays in place
+                print("Layout reload failed, keeping the current layout: {e!r}".format(e=exc))
+
+    def Reload(self):
+        """Load, check and swap in the current game.yml (or its pack). Returns True if swapped."""
+
+        roomsCur = self.m_server.m_rooms
+
+        # saving over game.yml with the same contents (or a touch) isn't worth a reload
+
+        with open(self.m_pathSource, 'rb') as fileIn:
+            strGen = layout.StrGenFromHash(hashlib.sha256(fileIn.read()).digest())
+        if strGen == roomsCur.m_strGen:
+            return False
+
+        rooms = gamepack.RoomsLoad(self.m_pathSource, self.m_pathPack)
+
+        strReport = rooms.StrGraphReport()
+        if strReport:
+            print(strReport)
+
+        if rooms.m_lStrBroken or rooms.m_roomStart is None:
+            print("Not reloading {p}: the new layout is broken".format(p=self.m_pathSource))
+            return False
+
+        # new logins and lazily loaded sessions pick up the new rooms from here on; sessions already
+        #  in memory are re-pointed by name
+
+        self.m_server.SetRooms(rooms)
+        cMissing = self.m_group.SwapRooms(rooms)
+        self.m_cReload += 1
+
+        print("Reloaded {p}: {c} rooms, generation {g}{m}".format(
+                p=self.m_pathSource,
+                c=len(rooms.m_lRoom),
+                g=rooms.m_strGen,
+                m=", {c} sessions left in removed rooms".format(c=cMissing) if cMissing else ''))
+
+        return True
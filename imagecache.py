@@ -0,0 +1,165 @@
+# in-memory cache of image files served under /image
+
+import collections
+import email.utils
+import hashlib
+import os
+import threading
+
+
+
+class ImageEntry:
+    """One image file's bytes plus the validators we hand out for it"""
+
+    def __init__(self, path, stat, aB):
+        self.m_path = path
+        self.m_nsMtime = stat.st_mtime_ns
+        self.m_cB = stat.st_size
+        self.m_aB = aB      # None for files big enough to be streamed from disk instead
+
+        if aB is not None:
+            self.m_strEtag = '"{h}"'.format(h=hashlib.blake2b(aB, digest_size=16).hexdigest())
+        else:
+            # don't read a big file just to hash it; identity + size + mtime changes whenever it does
+            self.m_strEtag = '"{i:x}-{c:x}-{t:x}"'.format(i=stat.st_ino, c=stat.st_size, t=stat.st_mtime_ns)
+
+        self.m_sMtime = int(stat.st_mtime)
+        self.m_strLastModified = email.utils.formatdate(self.m_sMtime, usegmt=True)
+
+    def FIsCurrent(self, stat):
+        return stat.st_mtime_ns == self.m_nsMtime and stat.st_size == self.m_cB
+
+    def FNotModified(self, headers):
+        """True if the request's conditional headers say the client already has this version"""
+
+        strIfNoneMatch = headers.get('If-None-Match')
+        if strIfNoneMatch is not None:
+            # If-None-Match wins over If-Modified-Since when both are present
+
+            for strTag in strIfNoneMatch.split(','):
+                strTag = strTag.strip()
+                if strTag.startswith('W/'):
+                    strTag = strTag[2:]
+                if strTag == '*' or strTag == self.m_strEtag:
+                    return True
+            return False
+
+        strIfModifiedSince = headers.get('If-Modified-Since')
+        if strIfModifiedSince is not None:
+            try:
+                dt = email.utils.parsedate_to_datetime(strIfModifiedSince)
+            except (TypeError, ValueError):
+                return False
+            return self.m_sMtime <= dt.timestamp()
+
+        return False
+
+    def FRangeApplies(self, headers):
+        """False if an If-Range header says the client's partial copy is of some other version"""
+
+        strIfRange = headers.get('If-Range')
+        if strIfRange is None:
+            return True
+
+        strIfRange = strIfRange.strip()
+        return strIfRange == self.m_strEtag or strIfRange == self.m_strLastModified
+
+
+
+class ImageCache:
+    """Bounded LRU of image file contents, keyed by path and checked against the file's mtime/size
+    on each use (one stat instead of exists + open + read). Files over cBEntryMax aren't read at all;
+    their entries just carry validators, and the bytes get streamed from disk."""
+
+    s_cBEntryStream = 256   # what we count a streamed entry as costing, for the size bound
+
+    def __init__(self, cBMax, cBEntryMax):
+        self.m_cBMax = cBMax
+        self.m_cBEntryMax = cBEntryMax
+        self.m_cB = 0
+        self.m_mpPathEntry = collections.OrderedDict()
+        self.m_lock = threading.Lock()
+
+    def CBCost(self, entry):
+        return entry.m_cB if entry.m_aB is not None else self.s_cBEntryStream
+
+    def Entry(self, path):
+        """Returns the ImageEntry for the file at path, or None if there is no such file"""
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        with self.m_lock:
+            entry = self.m_mpPathEntry.get(path)
+            if entry is not None and entry.FIsCurrent(stat):
+                self.m_mpPathEntry.move_to_end(path)
+                return entry
+
+        if stat.st_size > self.m_cBEntryMax:
+            aB = None
+        else:
+            try:
+                with open(path, 'rb') as fileIn:
+                    aB = fileIn.read()
+            except OSError:
+                return None
+
+        entry = ImageEntry(path, stat, aB)
+
+        with self.m_lock:
+            entryPrev = self.m_mpPathEntry.pop(path, None)
+            if entryPrev is not None:
+                self.m_cB -= self.CBCost(entryPrev)
+
+            self.m_mpPathEntry[path] = entry
+            self.m_cB += self.CBCost(entry)
+
+            while self.m_cB > self.m_cBMax and len(self.m_mpPathEntry) > 1:
+                _, entryOld = self.m_mpPathEntry.popitem(last=False)
+                self.m_cB -= self.CBCost(entryOld)
+
+        return entry
+
+def RangeParse(strRange, cB):
+    """Parse a Range header against a cB byte file. Returns (iBStart, cBRange) for a single
+    satisfiable range, None if the whole file should be sent instead (no, unsupported or invalid
+    header), or False if the range can't be satisfied."""
+
+    if strRange is None or not strRange.startswith('bytes='):
+        return None
+
+    lStrSpec = strRange[len('bytes='):].split(',')
+    if len(lStrSpec) != 1:
+        # multipart ranges aren't worth supporting for images; a full response is always allowed
+        return None
+
+    strStart, _, strEnd = lStrSpec[0].strip().partition('-')
+
+    try:
+        if strStart == '':
+            # suffix range: the last N bytes
+            cBSuffix = int(strEnd)
+            if cBSuffix <= 0:
+                return False
+            iBStart = max(0, cB - cBSuffix)
+            iBEnd = cB - 1
+        else:
+            iBStart = int(strStart)
+            iBEnd = int(strEnd) if strEnd else cB - 1
+
+            # a last byte before the first makes the header invalid (RFC 9110 says to ignore it),
+            #  which isn't the same as a range past the end of the file
+
+            if strEnd and iBEnd < iBStart:
+                return None
+
+            iBEnd = min(iBEnd, cB - 1)
+    except ValueError:
+        return None
+
+    if iBStart < 0 or iBStart >= cB or iBEnd < iBStart:
+        return False
+
+    return (iBStart, iBEnd - iBStart + 1)
@@ -1,23 +1,242 @@
 # room layout support and machinery
 
+import hashlib
+import operator
+import string
+import threading
 import yaml
 
+# exit condition comparisons; each also has a "var" form (e.g. gtvar) comparing against another variable
+
+s_mpStrOpFnCompare = {
+        'eq' : operator.eq,
+        'gt' : operator.gt,
+        'lt' : operator.lt,
+        'ne' : operator.ne,
+    }
+
+class FormatterDefaultZero(string.Formatter):
+    """Formatter that treats any missing variable as 0 rather than raising"""
+
+    def get_value(self, key, args, kwargs):
+        return kwargs.get(key, 0)
+
+class Text:
+    """Authored text (desc, verb) with {var} fields for session variables. It is parsed once, so
+    formatting is a single pass with missing variables treated as 0 (and never added to the session).
+    Raises ValueError if the text isn't a valid format string."""
+
+    s_formatter = FormatterDefaultZero()
+
+    def __init__(self, strIn):
+        self.m_str = strIn
+        self.m_lPart = []       # (literal text, var name or None)
+        self.m_fSimple = True   # every field is a plain {var}, no conversion/spec/index
+
+        for strLiteral, strField, strSpec, strConv in string.Formatter().parse(strIn):
+            if strField is not None and (strSpec or strConv or not strField.isidentifier()):
+                self.m_fSimple = False
+            self.m_lPart.append((strLiteral, strField))
+
+        self.m_fStatic = all(strField is None for _, strField in self.m_lPart)
+
+    def StrFormat(self, mpVarVal):
+        """Format against the given var map"""
+
+        if not self.m_fSimple:
+            return self.s_formatter.vformat(self.m_str, (), mpVarVal)
+
+        get = mpVarVal.get
+        lStr = []
+        for strLiteral, strField in self.m_lPart:
+            lStr.append(strLiteral)
+            if strField is not None:
+                lStr.append(str(get(strField, 0)))
+
+        return ''.join(lStr)
+
+def TextTryParse(strIn, lStrErr):
+    """Returns Text for strIn, or None (noting why in lStrErr) if it isn't valid text"""
+
+    if not isinstance(strIn, str):
+        lStrErr.append("{s!r} is not text".format(s=strIn))
+        return None
+
+    try:
+        return Text(strIn)
+    except ValueError as err:
+        lStrErr.append("Bad format in {s!r}: {e}".format(s=strIn, e=err))
+        return None
+
+def FFalse(mpVarVal):
+    return False
+
+def FnCompileCond(cond, lStrErr):
+    """Compile an exit condition (as authored in yaml) into a predicate taking the session's var map.
+    Same results as Session.FEvaluateCond, but the structure is only walked once, and/or short
+    circuit, and constants are converted to ints up front. Problems are appended to lStrErr."""
+
+    if isinstance(cond, dict):
+        if len(cond) != 1:
+            return FFalse
+
+        if 'and' in cond:
+            lCond = cond['and']
+        elif 'or' in cond:
+            lCond = cond['or']
+        else:
+            return FFalse
+
+        if not isinstance(lCond, list) or not lCond:
+            return FFalse
+
+        lFn = tuple(FnCompileCond(x, lStrErr) for x in lCond)
+        if len(lFn) == 1:
+            return lFn[0]
+
+        if 'and' in cond:
+            def FAnd(mpVarVal):
+                for fn in lFn:
+                    if not fn(mpVarVal):
+                        return False
+                return True
+            return FAnd
+
+        def FOr(mpVarVal):
+            for fn in lFn:
+                if fn(mpVarVal):
+                    return True
+            return False
+        return FOr
+
+    elif isinstance(cond, list):
+        # should be a three part list: op, var, value
+
+        if len(cond) != 3:
+            return FFalse
+
+        op, var, value = cond
+        if not isinstance(op, str):
+            return FFalse
+
+        fVar = op.endswith('var')
+        fnCompare = s_mpStrOpFnCompare.get(op[:-3] if fVar else op)
+        if fnCompare is None:
+            return FFalse
+
+        if fVar:
+            # compare against another variable, looked up at evaluation time
+            def FCompareVar(mpVarVal):
+                return fnCompare(mpVarVal.get(var, 0), int(mpVarVal.get(value, 0)))
+            return FCompareVar
+
+        try:
+            n = int(value)
+        except (TypeError, ValueError):
+            lStrErr.append("Condition {c} compares against non-integer {v}".format(c=cond, v=value))
+            return FFalse
+
+        def FCompare(mpVarVal):
+            return fnCompare(mpVarVal.get(var, 0), n)
+        return FCompare
+
+    return FFalse
+
+class Exit:
+    """A way out of a room, possibly only available when its condition holds"""
+
+    def __init__(self):
+        self.m_name = None
+        self.m_verb = None
+        self.m_textVerb = None
+        self.m_cond = None
+        self.m_fnCond = None
+        self.m_lStrErr = []
+        self.m_abFormPre = None
+        self.m_abFormMid = None
+        self.m_abVerb = None        # None if the verb has to be formatted per session
+        self.m_abFormPost = None
+        self.m_idDest = None        # destination room id, filled in by Rooms once every room is known
+
+    def Load(self, doc):
+        """Serialize in an exit from its yaml source (one entry in a room's exits list)"""
+        self.m_name = doc.get('name')
+        self.m_verb = doc.get('verb')
+        self.m_cond = doc.get('cond')
+
+        if self.m_verb is not None:
+            self.m_textVerb = TextTryParse(self.m_verb, self.m_lStrErr)
+
+        # conditions are compiled once here rather than interpreted on each render
+
+        if self.m_cond is not None:
+            self.m_fnCond = FnCompileCond(self.m_cond, self.m_lStrErr)
+
+    def CompileForm(self, room, iExit):
+        """Pre-encode the form for this exit (exit iExit of room), leaving slots for the sid and, if
+        it uses session vars, the verb"""
+
+        # NOTE that by using a separate form for each exit, we can thus include the index as a different
+        #  value so that we can distinguish which exit was selected. The layout generation and room id
+        #  go along with it, so a form from some other room or an older layout (stale page, other tab,
+        #  reload) can't pick the wrong exit.
+
+        self.m_abFormPre = '\n'.join([
+                '',
+                '<form action="/room" method="post">',
+                '<input type="hidden" name="sid" id="sid" value="',
+            ]).encode()
+        self.m_abFormMid = '\n'.join([
+                '"/>',
+                '<input type="hidden" name="cur" id="cur" value="{cur}"/>'.format(cur=room.m_name),
+                '<input type="hidden" name="dest" id="dest" value="{dest}"/>'.format(dest=self.m_name),
+                '<input type="hidden" name="exit" id="exit" value="{g}.{id}.{i}"/>'.format(g=room.m_strGen, id=room.m_id, i=iExit),
+                '<input type="submit" value="',
+            ]).encode()
+        self.m_abVerb = self.m_textVerb.StrFormat({}).encode() if self.m_textVerb.m_fStatic else None
+        self.m_abFormPost = '\n'.join([
+                '"/>',
+                '</form>',
+            ]).encode()
+
 class Room:
     """A single room in the game area"""
 
     def __init__(self):
+        self.m_id = None            # index in Rooms.m_lRoom
+        self.m_strGen = ''          # Rooms.m_strGen of the layout this room came from
         self.m_name = None
         self.m_desc = None
+        self.m_textDesc = None
+        self.m_lStrErrText = []
         self.m_lExit = []
         self.m_lChange = []
+        self.m_abPageHead = None
+        self.m_abDesc = None        # None if the desc has to be formatted per session
+        self.m_abPageMid = None
+        self.m_abPageTail = None
+        self.m_lExitPage = []
 
     def Load(self, doc):
         """Serialize in a room from a yaml source doc"""
         self.m_name = doc.get('name')
         self.m_desc = doc.get('desc')
         self.m_lExit = doc.get('exits')
+
+        if self.m_desc is not None:
+            self.m_textDesc = TextTryParse(self.m_desc, self.m_lStrErrText)
         self.m_lChange = doc.get('changes', [])
 
+        if isinstance(self.m_lExit, list):
+            lExit = []
+            for docExit in self.m_lExit:
+                if not isinstance(docExit, dict):
+                    continue
+                exit = Exit()
+                exit.Load(docExit)
+                lExit.append(exit)
+            self.m_lExit = lExit
+
         # HINT: expect something like the lines above for the room to know its type
 
         # HINT: if we have a grid type room, we may also want to load in the template
@@ -36,6 +255,9 @@ class Room:
         if self.m_desc is None:
             lStrErr.append("Room {r} is missing desc".format(r=self.m_name))
 
+        for strErr in self.m_lStrErrText:
+            lStrErr.append("Room {r} desc: {err}".format(r=self.m_name, err=strErr))
+
         # HINT: if this is a grid room, we should verify that self.m_desc has the
         #  fields we expect, with appropriate contents, etc.
 
@@ -43,16 +265,73 @@ class Room:
             lStrErr.append("Room {r} is missing exits".format(r=self.m_name))
         elif not isinstance(self.m_lExit, list):
             lStrErr.append("Room {r} exits is not a list".format(r=self.m_name))
+        else:
+            for exit in self.m_lExit:
+                for strErr in exit.m_lStrErr:
+                    lStrErr.append("Room {r} exit {e}: {err}".format(r=self.m_name, e=exit.m_name, err=strErr))
 
         if self.m_lChange is None:
             pass    # OK to not have changes
         elif not isinstance(self.m_lChange, list):
             lStrErr.append("Room {r} changes is not a list".format(r=self.m_name))
 
-        # TODO: check exits, changes, if present, for validity as well
+        # TODO: check changes, if present, for validity as well
 
         return '\n'.join(lStrErr)
 
+    def CompilePage(self):
+        """Pre-encode everything about this room's page that doesn't depend on the session, so a
+        render only has to fill in the sid, formatted text, and which exits are visible"""
+
+        self.m_abPageHead = '\n'.join([
+                '<html>',
+                '<head>',
+                '<title>{name}</title>'.format(name=self.m_name),
+                '</head>',
+                '<body>',
+                '<h1>{name}</h1>'.format(name=self.m_name),
+                '<p>',
+            ]).encode()
+        self.m_abDesc = self.m_textDesc.StrFormat({}).encode() if self.m_textDesc.m_fStatic else None
+        self.m_abPageMid = '</p>'.encode()
+
+        # TODO add generic links for logout, about, any others here
+
+        self.m_abPageTail = '\n'.join([
+                '',
+                '</body>',
+                '</html>',
+            ]).encode()
+
+        # exits without a name or verb are never shown
+
+        self.m_lExitPage = [exit for exit in self.m_lExit if exit.m_name is not None and exit.m_verb is not None]
+        for iExit, exit in enumerate(self.m_lExitPage):
+            exit.CompileForm(self, iExit)
+
+    def IdDestFromExitKey(self, strKey):
+        """Destination room id for an exit key posted by one of our forms ("<generation>.<room id>.<exit
+        index>"), or None if the key is missing, malformed, or from some other room or layout"""
+
+        if strKey is None:
+            return None
+
+        lStr = strKey.split('.')
+        if len(lStr) != 3 or lStr[0] != self.m_strGen:
+            return None
+
+        _, strId, strIExit = lStr
+        try:
+            idRoom = int(strId)
+            iExit = int(strIExit)
+        except ValueError:
+            return None
+
+        if idRoom != self.m_id or iExit < 0 or iExit >= len(self.m_lExitPage):
+            return None
+
+        return self.m_lExitPage[iExit].m_idDest
+
     def LExit(self):
         return self.m_lExit
 
@@ -66,40 +345,164 @@ class Room:
     #    put those divs into the template
     #    return the combined template/divs as the page content
 
+def StrGenFromHash(abHash):
+    """Layout generation for a game.yml with the given sha256; the same content always gets the
+    same generation, across restarts and reloads"""
+
+    return abHash.hex()[:12]
+
 class Rooms:
-    """Stores information about the whole room layout"""
+    """Stores information about the whole room layout. Rooms are numbered in load order; when
+    loaded from a game pack, each one is only decoded the first time it's asked for."""
 
     def __init__(self):
-        self.m_mpNameRoom = {}
+        self.m_mpNameRoom = {}      # decoded rooms only
+        self.m_mpNameId = {}
+        self.m_lRoom = []           # by id; None for rooms not decoded yet
         self.m_roomStart = None
+        self.m_lStrBroken = []
+        self.m_lNameUnreachable = []
+        self.m_strGen = ''
+        self.m_pack = None
+        self.m_lock = threading.Lock()
 
     def Load(self, path):
-        with open(path, 'r') as fileIn:
-            for doc in yaml.safe_load_all(fileIn):
-                if doc is None:
-                    continue
+        with open(path, 'rb') as fileIn:
+            abYaml = fileIn.read()
 
-                room = Room()
-                room.Load(doc)
-                strErr = room.StrErrors()
-
-                if strErr:
-                    print(strErr)
-                elif room.m_name in self.m_mpNameRoom:
-                    print("Room {r} defined more than once!".format(r=room.m_name))
-                else:
-                    self.m_mpNameRoom[room.m_name] = room
-                    if self.m_roomStart is None:
-                        # TODO: come up with a better plan here
-                        self.m_roomStart = room
+        self.m_strGen = StrGenFromHash(hashlib.sha256(abYaml).digest())
+
+        for doc in yaml.safe_load_all(abYaml):
+            strErr = self.StrAddDoc(doc)
+            if strErr:
+                print(strErr)
+
+        self.LinkExits()
+
+    def StrAddDoc(self, doc):
+        """Add the room defined by a yaml source doc, returning why it was rejected (or '' if it wasn't)"""
+
+        if doc is None:
+            return ''
+
+        room = Room()
+        room.Load(doc)
+        strErr = room.StrErrors()
+
+        if strErr:
+            return strErr
+
+        if room.m_name in self.m_mpNameRoom:
+            return "Room {r} defined more than once!".format(r=room.m_name)
+
+        room.m_id = len(self.m_lRoom)
+        room.m_strGen = self.m_strGen
+        room.CompilePage()
+        self.m_mpNameRoom[room.m_name] = room
+        self.m_mpNameId[room.m_name] = room.m_id
+        self.m_lRoom.append(room)
+        if self.m_roomStart is None:
+            # TODO: come up with a better plan here
+            self.m_roomStart = room
+
+        return ''
+
+    def LoadPack(self, pack):
+        """Take the layout from a gamepack.Pack. Only the index is read now; the pack already holds
+        the exit links and graph report, and rooms are decoded by RoomFromId as they're needed."""
+
+        self.m_pack = pack
+        self.m_strGen = StrGenFromHash(pack.m_abHashSource)
+        self.m_lRoom = [None] * len(pack.m_lName)
+        self.m_mpNameId = {name : idRoom for idRoom, name in enumerate(pack.m_lName)}
+        self.m_lStrBroken = pack.m_lStrBroken
+        self.m_lNameUnreachable = pack.m_lNameUnreachable
+
+        for strErr in pack.m_lStrErr:
+            print(strErr)
+
+        if self.m_lRoom:
+            self.m_roomStart = self.RoomFromId(0)
+
+    def LinkExits(self):
+        """Resolve every exit's destination to a room id, noting exits to rooms that don't exist
+        and rooms that can't be reached from the start room"""
+
+        self.m_lStrBroken = []
+        for room in self.m_lRoom:
+            for exit in room.m_lExitPage:
+                exit.m_idDest = self.m_mpNameId.get(exit.m_name)
+                if exit.m_idDest is None:
+                    self.m_lStrBroken.append("Room {r} has an exit to missing room {d}".format(r=room.m_name, d=exit.m_name))
+
+        # anything not reachable by some path of exits from the start (ignoring conditions) can never be visited
+
+        aFReached = [False] * len(self.m_lRoom)
+        lRoomTodo = []
+        if self.m_roomStart is not None:
+            aFReached[self.m_roomStart.m_id] = True
+            lRoomTodo.append(self.m_roomStart)
+
+        while lRoomTodo:
+            room = lRoomTodo.pop()
+            for exit in room.m_lExitPage:
+                idDest = exit.m_idDest
+                if idDest is not None and not aFReached[idDest]:
+                    aFReached[idDest] = True
+                    lRoomTodo.append(self.m_lRoom[idDest])
+
+        self.m_lNameUnreachable = [room.m_name for room in self.m_lRoom if not aFReached[room.m_id]]
+
+    def StrGraphReport(self):
+        """Describe broken exits and unreachable rooms (empty string if there are none)"""
+
+        lStr = list(self.m_lStrBroken)
+        for name in self.m_lNameUnreachable:
+            lStr.append("Room {r} can't be reached from {s}".format(r=name, s=self.m_roomStart.m_name))
+
+        return '\n'.join(lStr)
 
     def Room(self, name):
         """Return the room by the given name, or None if there is no such room"""
 
-        return self.m_mpNameRoom.get(name, None)
+        room = self.m_mpNameRoom.get(name, None)
+        if room is None and self.m_pack is not None:
+            idRoom = self.m_mpNameId.get(name)
+            if idRoom is not None:
+                room = self.RoomFromId(idRoom)
+
+        return room
+
+    def RoomFromId(self, idRoom):
+        """Return the room with the given id (which must exist), decoding it from the pack if need be"""
+
+        room = self.m_lRoom[idRoom]
+        if room is not None:
+            return room
+
+        with self.m_lock:
+            room = self.m_lRoom[idRoom]
+            if room is None:
+                room = Room()
+                room.Load(self.m_pack.DocFromId(idRoom))
+                room.m_id = idRoom
+                room.m_strGen = self.m_strGen
+                room.CompilePage()
+                for exit, idDest in zip(room.m_lExitPage, self.m_pack.m_llIdDest[idRoom]):
+                    exit.m_idDest = idDest
+
+                # publish only once it's complete, since readers don't take the lock
+
+                self.m_mpNameRoom[room.m_name] = room
+                self.m_lRoom[idRoom] = room
+
+        return room
 
 if __name__ == '__main__':
     # testing code if we run layout directly
     rooms = Rooms()
     rooms.Load('example_layout.yml')
+    strReport = rooms.StrGraphReport()
+    if strReport:
+        print(strReport)
     print("Finished loading example layout (errors, if any, are above)")
@@ -1,28 +1,180 @@
 # front end driver for web-adventure
 
 import argparse
-import layout
+import contentcoding
+import gamepack
+import hotreload
 import os
+import prefork
 import server
 import session
+import signal
+import store
+import sys
+import tracing
+
+def RunServer(args, rooms, sock=None):
+    """Set up sessions and serve. With sock (an inherited listening socket), this is one of several
+    pre-forked workers: sessions and sids live in sessions.db, shared with the other workers."""
+
+    # with several workers, each gets its own trace/profile output
+
+    strSuffix = '' if sock is None else '.{pid}'.format(pid=os.getpid())
+
+    if args.trace_file:
+        tracing.g_tracer.Open(args.trace_file + strSuffix, args.trace_sample / 100)
+
+    contentcoding.g_coder.Configure(args.gzip_level, args.gzip_min_bytes)
+
+    group = session.Group()
+    if args.store == 'journal':
+        group.SetStore(store.JournalStore("journal"))
+    elif args.store == 'sqlite':
+        # with several workers, every save has to be committed right away for the others to see it
+
+        group.SetStore(store.SqliteStore("sessions.db", cSaveBatch=1 if sock is not None else None))
+    if sock is not None:
+        group.SetShared()
+    group.SetSessionMax(args.session_cache)
+    group.Load("sessions", args.lazy_sessions, args.load_procs)
+    group.InitRooms(rooms)
+    print("Loaded {c} sessions: {t}".format(c=len(group.m_mpUidSession), t=group.StrTimings()))
+
+    # only now that loading is done: the session parsing processes are forked from us, and a fork
+    #  taken while the credential pool's thread holds a lock can leave the child hung on it
+
+    if args.hash_workers > 0:
+        # the hashing processes are forked from us too, so they mustn't hang on to a shared
+        #  listening socket (it would stay bound after we exit)
+
+        lFdClose = [sock.fileno()] if sock is not None else []
+        session.g_credpool = session.CredPool(args.hash_workers, args.hash_queue, lFdClose)
+
+    if args.write_behind > 0:
+        group.StartWriteBehind(args.write_behind, args.flush_dirty_max)
+
+    # turn SIGTERM into a normal exit so that the final flush below happens
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    serverMain = server.Server()
+    serverMain.SetRooms(rooms)
+    if sock is not None:
+        serverMain.SetSidRegistry(server.SharedSidRegistry("sessions.db", group))
+    serverMain.SetGroup(group)
+    serverMain.SetSidTimeouts(args.sid_idle, args.sid_max_age)
+    serverMain.SetPostLimits(args.post_max_bytes, args.post_timeout)
+    serverMain.SetImageCache(args.image_cache_mb * 1024 * 1024, args.image_stream_kb * 1024)
+
+    if args.profile:
+        profiler = tracing.Profiler('profile.pstats' + strSuffix)
+        profiler.Start()
+        serverMain.SetProfiler(profiler)
+
+    watcher = hotreload.LayoutWatcher(serverMain, group, "game.yml", args.game_pack, args.watch_layout)
+    watcher.Start()
+
+    try:
+        serverMain.Run(args.engine, args.port, sock)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lUidUnsaved = group.Shutdown()
+        if session.g_credpool is not None:
+            session.g_credpool.Shutdown()
+
+        # (this also turns a SIGTERM's clean exit into a failing one)
+
+        if lUidUnsaved:
+            sys.exit("Could not save {c} sessions, their latest changes are lost: {l}".format(
+                    c=len(lUidUnsaved), l=', '.join(lUidUnsaved)))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run the web-adventure server")
+    parser.add_argument('command', nargs='?', default='serve', choices=['serve', 'compile'],
+                        help="Run the server, or compile game.yml into the game pack and exit")
     parser.add_argument('--datadir', default='.', help="Select the data directory")
+    parser.add_argument('--game-pack', default='game.pack',
+                        help="Precompiled layout to load instead of game.yml, when it is up to date")
+    parser.add_argument('--engine', default='threading', choices=server.Server.s_lStrEngine, help="Select the serving engine")
+    parser.add_argument('--port', default=8000, type=int, help="Port to listen on")
+    parser.add_argument('--workers', default=1, type=int,
+                        help="Pre-fork this many server processes sharing the port (needs --store sqlite)")
+    parser.add_argument('--hash-workers', default=max(1, (os.cpu_count() or 2) // 2), type=int,
+                        help="Worker processes for password hashing (0 hashes on the request thread)")
+    parser.add_argument('--hash-queue', default=32, type=int,
+                        help="Max hashes queued or running before logins are told to retry")
+    parser.add_argument('--write-behind', default=0.0, type=float, metavar='SECONDS',
+                        help="Queue session saves and flush them every SECONDS (0 saves on every move)")
+    parser.add_argument('--flush-dirty-max', default=100, type=int,
+                        help="With --write-behind, flush early once this many sessions are waiting")
+    parser.add_argument('--store', default='yaml', choices=['yaml', 'journal', 'sqlite'],
+                        help="Where sessions live: one yaml file each, a single journal, or a sqlite database")
+    parser.add_argument('--lazy-sessions', action='store_true',
+                        help="Only index session files at startup, and parse each one when first used")
+    parser.add_argument('--session-cache', default=0, type=int,
+                        help="Keep at most this many sessions in memory, evicting idle ones that can be reloaded (0 = no limit)")
+    parser.add_argument('--load-procs', default=os.cpu_count() or 1, type=int,
+                        help="Worker processes used to parse session files at startup")
+    parser.add_argument('--sid-idle', default=3600, type=float,
+                        help="Seconds a login (sid) may go unused before it expires (0 = never)")
+    parser.add_argument('--sid-max-age', default=24 * 3600, type=float,
+                        help="Seconds after login that a sid expires regardless of use (0 = never)")
+    parser.add_argument('--watch-layout', default=0.0, type=float, metavar='SECONDS',
+                        help="Check game.yml for changes every SECONDS and reload it in place (SIGHUP always reloads)")
+    parser.add_argument('--post-max-bytes', default=server.Server.s_cBPostMax, type=int,
+                        help="Reject POST bodies bigger than this")
+    parser.add_argument('--post-timeout', default=server.Server.s_sPostTimeout, type=float, metavar='SECONDS',
+                        help="Reject POST bodies that take longer than this to arrive")
+    parser.add_argument('--gzip-level', default=contentcoding.Coder.s_level, type=int, choices=range(10), metavar='0-9',
+                        help="Compression level for pages sent to clients that accept gzip/deflate (0 = never compress)")
+    parser.add_argument('--gzip-min-bytes', default=contentcoding.Coder.s_cBMin, type=int,
+                        help="Only compress pages at least this big")
+    parser.add_argument('--trace-file', help="Write spans for sampled requests to this file (Chrome trace event JSON)")
+    parser.add_argument('--trace-sample', default=1.0, type=float, metavar='PERCENT',
+                        help="With --trace-file, the percentage of requests to trace")
+    parser.add_argument('--profile', action='store_true',
+                        help="Profile every request with cProfile; SIGUSR1 writes the totals to profile.pstats and prints the top")
+    parser.add_argument('--image-cache-mb', default=64, type=int,
+                        help="Megabytes of image data to keep in memory")
+    parser.add_argument('--image-stream-kb', default=1024, type=int,
+                        help="Images bigger than this many kilobytes are streamed from disk with sendfile")
     args = parser.parse_args()
 
+    if args.workers > 1:
+        if args.store != 'sqlite':
+            parser.error("--workers needs --store sqlite, so that every worker sees the same sessions")
+        if args.write_behind > 0:
+            parser.error("--workers can't be combined with --write-behind")
+
     # change to the appropriate directory
 
     os.chdir(args.datadir)
 
-    rooms = layout.Rooms()
-    rooms.Load("game.yml")
+    if args.command == 'compile':
+        rooms = gamepack.Compile("game.yml", args.game_pack)
+        strReport = rooms.StrGraphReport()
+        if strReport:
+            print(strReport)
+        print("Compiled {c} rooms into {p}".format(c=len(rooms.m_lRoom), p=args.game_pack))
+        sys.exit(1 if rooms.m_lStrBroken else 0)
 
-    group = session.Group()
-    group.Load("sessions")
-    group.InitRooms(rooms)
+    rooms = gamepack.RoomsLoad("game.yml", args.game_pack)
+
+    # a layout with exits to nowhere is broken; better to find out now than from a player
+
+    strReport = rooms.StrGraphReport()
+    if strReport:
+        print(strReport)
+    if rooms.m_lStrBroken:
+        sys.exit("game.yml has broken exits; not starting")
+
+    # Workers are forked before anything starts threads or processes (credential pool, flusher,
+    #  sqlite connections); the rooms loaded above are shared with them copy-on-write
 
-    server = server.Server()
-    server.SetRooms(rooms)
-    server.SetGroup(group)
-    server.Run()
+    if args.workers > 1:
+        sock = prefork.SockListen(args.port)
+        supervisor = prefork.Supervisor(args.workers, sock, lambda sock, iWorker: RunServer(args, rooms, sock))
+        supervisor.Run()
+    else:
+        RunServer(args, rooms)
@@ -0,0 +1,114 @@
+# request/latency metrics, exposed in the Prometheus text format at /metrics
+
+import bisect
+import threading
+
+class Metrics:
+    """Counters and latency histograms that request threads update without taking a lock. Each
+    thread writes only to its own shard (keyed by thread ident; the OS reuses idents, so there are
+    about as many shards as the peak number of concurrent threads), and a scrape adds them up.
+    Gauges are functions evaluated at scrape time."""
+
+    s_aSBucket = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.m_mpIdentShard = {}
+        self.m_mpNameTypeHelp = {}      # name -> (type, help), in registration order
+        self.m_mpNameFnGauge = {}
+
+    def Describe(self, name, strType, strHelp):
+        self.m_mpNameTypeHelp[name] = (strType, strHelp)
+
+    def SetGauge(self, name, strHelp, fn, strType='gauge'):
+        """Report fn() as name at each scrape (strType 'counter' for values that only go up)"""
+
+        self.Describe(name, strType, strHelp)
+        self.m_mpNameFnGauge[name] = fn
+
+    def Shard(self):
+        ident = threading.get_ident()
+        shard = self.m_mpIdentShard.get(ident)
+        if shard is None:
+            shard = {}
+            self.m_mpIdentShard[ident] = shard
+        return shard
+
+    def Count(self, name, strLabels='', c=1):
+        shard = self.Shard()
+        key = (name, strLabels)
+        shard[key] = shard.get(key, 0) + c
+
+    def Observe(self, name, strLabels, s):
+        """Add one sample of s seconds to the histogram name{strLabels}"""
+
+        shard = self.Shard()
+        key = (name, strLabels)
+        aC = shard.get(key)
+        if aC is None:
+            # a count per bucket, then +Inf, then the sum
+            aC = [0] * (len(self.s_aSBucket) + 1) + [0.0]
+            shard[key] = aC
+        aC[bisect.bisect_left(self.s_aSBucket, s)] += 1
+        aC[-1] += s
+
+    def StrExposition(self):
+        """Everything recorded so far, in the Prometheus text exposition format"""
+
+        # list() over a dict is done without releasing the GIL, so these are safe against threads
+        #  adding shards or keys meanwhile; values may be a request or so behind, which is fine
+
+        mpKeyTotal = {}
+        for shard in list(self.m_mpIdentShard.values()):
+            for key, value in list(shard.items()):
+                total = mpKeyTotal.get(key)
+                if total is None:
+                    mpKeyTotal[key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    for i, c in enumerate(value):
+                        total[i] += c
+                else:
+                    mpKeyTotal[key] = total + value
+
+        mpNameLKey = {}
+        for key in sorted(mpKeyTotal):
+            mpNameLKey.setdefault(key[0], []).append(key)
+
+        lStr = []
+        for name, (strType, strHelp) in self.m_mpNameTypeHelp.items():
+            lStr.append('# HELP {n} {h}'.format(n=name, h=strHelp))
+            lStr.append('# TYPE {n} {t}'.format(n=name, t=strType))
+
+            fnGauge = self.m_mpNameFnGauge.get(name)
+            if fnGauge is not None:
+                lStr.append('{n} {v}'.format(n=name, v=fnGauge()))
+                continue
+
+            for key in mpNameLKey.get(name, ()):
+                strLabels = key[1]
+                total = mpKeyTotal[key]
+                strBraced = '{' + strLabels + '}' if strLabels else ''
+                if strType != 'histogram':
+                    lStr.append('{n}{l} {v}'.format(n=name, l=strBraced, v=total))
+                    continue
+
+                strSep = ',' if strLabels else ''
+                cCumulative = 0
+                for sBucket, c in zip(self.s_aSBucket, total):
+                    cCumulative += c
+                    lStr.append('{n}_bucket{{{l}{p}le="{b}"}} {c}'.format(n=name, l=strLabels, p=strSep, b=sBucket, c=cCumulative))
+                cCumulative += total[-2]
+                lStr.append('{n}_bucket{{{l}{p}le="+Inf"}} {c}'.format(n=name, l=strLabels, p=strSep, c=cCumulative))
+                lStr.append('{n}_sum{l} {s}'.format(n=name, l=strBraced, s=total[-1]))
+                lStr.append('{n}_count{l} {c}'.format(n=name, l=strBraced, c=cCumulative))
+
+        lStr.append('')
+        return '\n'.join(lStr)
+
+g_metrics = Metrics()
+
+g_metrics.Describe('webadv_request_seconds', 'histogram', "Time to dispatch and answer a request, by method and route")
+g_metrics.Describe('webadv_creds_check_seconds', 'histogram', "Time to check a login's password (FMatchesCreds)")
+g_metrics.Describe('webadv_render_seconds', 'histogram', "Time to render a room page (RenderRoomCur)")
+g_metrics.Describe('webadv_session_save_seconds', 'histogram', "Time to persist a session (Session.Save)")
+g_metrics.Describe('webadv_post_rejected_total', 'counter', "POST bodies turned away (too big, too slow, malformed), by status")
+g_metrics.Describe('webadv_image_bytes_total', 'counter', "Image bytes sent (bodies of 200 and 206 responses)")
@@ -0,0 +1,101 @@
+# pre-fork worker processes sharing one listening socket
+
+import os
+import signal
+import socket
+import time
+import traceback
+
+def SockListen(port, cBacklog=128):
+    """Listening socket on all interfaces, to be inherited by every worker"""
+
+    return socket.create_server(('', port), backlog=cBacklog)
+
+class Supervisor:
+    """Forks cWorker processes that each run fnWorker(sock, iWorker) on the same listening socket,
+    and keeps that many running until told to stop. The kernel spreads incoming connections across
+    the workers' accept calls. SIGTERM and SIGHUP are passed along to every worker."""
+
+    s_sCrashLoop = 2.0      # a worker that dies sooner than this after starting isn't restarted
+
+    def __init__(self, cWorker, sock, fnWorker):
+        self.m_cWorker = cWorker
+        self.m_sock = sock
+        self.m_fnWorker = fnWorker
+        self.m_mpPidIWorker = {}
+        self.m_mpPidSStart = {}
+        self.m_fStop = False
+
+    def PidSpawn(self, iWorker):
+        pid = os.fork()
+        if pid != 0:
+            self.m_mpPidIWorker[pid] = iWorker
+            self.m_mpPidSStart[pid] = time.monotonic()
+            return pid
+
+        # worker: put signal handling back the way a fresh process has it, run, and never return
+        #  into the supervisor's code
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        code = 0
+        try:
+            self.m_fnWorker(self.m_sock, iWorker)
+        except SystemExit as exc:
+            code = exc.code if isinstance(exc.code, int) else 0
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def Signal(self, signum):
+        for pid in list(self.m_mpPidIWorker):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def OnStop(self, signum, frame):
+        self.m_fStop = True
+
+        # Ctrl-C already reached every worker (same process group); anything else is passed along
+
+        if signum != signal.SIGINT:
+            self.Signal(signum)
+
+    def Run(self):
+        """Start the workers and wait for them; returns once they've all exited after a stop"""
+
+        signal.signal(signal.SIGTERM, self.OnStop)
+        signal.signal(signal.SIGINT, self.OnStop)
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.Signal(signum))
+
+        for iWorker in range(self.m_cWorker):
+            self.PidSpawn(iWorker)
+
+        while self.m_mpPidIWorker:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            iWorker = self.m_mpPidIWorker.pop(pid, None)
+            sStart = self.m_mpPidSStart.pop(pid, None)
+            if iWorker is None or self.m_fStop:
+                continue
+
+            sLived = time.monotonic() - sStart
+            print("Worker {i} (pid {p}) exited with status {s} after {t:.1f}s".format(
+                    i=iWorker, p=pid, s=os.waitstatus_to_exitcode(status), t=sLived))
+
+            if sLived < self.s_sCrashLoop:
+                print("Not restarting worker {i}; it isn't staying up".format(i=iWorker))
+            else:
+                self.PidSpawn(iWorker)
+
+        self.m_sock.close()
@@ -1,8 +1,19 @@
 # http server driver and associated machinery
 
+import asyncengine
+import contentcoding
+import formdata
+import heapq
 import http.server as Hs
+import imagecache
+import metrics
 import os
 import secrets
+import session
+import sqlite3
+import threading
+import time
+import tracing
 
 
 
@@ -11,6 +22,12 @@ class Handler(Hs.BaseHTTPRequestHandler):
 
     # docs say not to override/extend __init__ method, so we do not
 
+    # every response carries a Content-Length, so connections can be kept alive between requests;
+    #  an idle one gives up its thread after timeout seconds
+
+    protocol_version = 'HTTP/1.1'
+    timeout = 60
+
     def do_POST(self):
         """Called to respond to an HTTP POST"""
 
@@ -21,6 +38,39 @@ class Handler(Hs.BaseHTTPRequestHandler):
 
         g_server.HandleGet(self)
 
+    def SendFile(self, fileIn, iBStart, cB):
+        """Send cB bytes of fileIn from iBStart straight to the socket (os.sendfile where the
+        platform has it), after the headers. Takes ownership of fileIn."""
+
+        with fileIn:
+            self.wfile.flush()
+            self.connection.sendfile(fileIn, iBStart, cB)
+
+    def EndHeadersWithBody(self, abBody):
+        """end_headers, then abBody, with headers and body going out together in one vectored
+        send rather than a write each"""
+
+        lAb = getattr(self, '_headers_buffer', None)
+        if lAb is None or not hasattr(self.connection, 'sendmsg'):
+            self.end_headers()
+            self.wfile.write(abBody)
+            return
+
+        lAb.append(b'\r\n')
+        lAb.append(abBody)
+        self._headers_buffer = []
+
+        # sendmsg can stop short like send does, so pick up wherever it left off
+
+        lMv = [memoryview(ab) for ab in lAb]
+        while lMv:
+            cB = self.connection.sendmsg(lMv)
+            while lMv and cB >= len(lMv[0]):
+                cB -= len(lMv[0])
+                del lMv[0]
+            if lMv:
+                lMv[0] = lMv[0][cB:]
+
     def ExamplePostPageNotCalled(self):
         self.send_response(200)
         self.send_header('myheader', 'myvalue')
@@ -67,9 +117,7 @@ class Handler(Hs.BaseHTTPRequestHandler):
 
 
     def SendErrorPage(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write('''<html>
+        contentcoding.g_coder.Send(self, 200, '''<html>
                 <head><title>Oops!</title></head>
                 <body>
                 <h1>Oops!</h1>
@@ -81,15 +129,295 @@ class Handler(Hs.BaseHTTPRequestHandler):
 
 
 
+class SidRegistry:
+    """Two-way map between sids and the sessions they belong to, safe to use from concurrent
+    handlers. Lookups, registration and revocation are all O(1) (per sid involved). Optionally sids
+    expire after sIdle seconds unused or sAbsolute seconds after creation; a reaper thread sweeps
+    them out using a heap of deadlines."""
+
+    def __init__(self):
+        self.m_mpSidSession = {}
+        self.m_mpSessionSetSid = {}
+        self.m_mpSidSCreated = {}
+        self.m_mpSidSUsed = {}
+        self.m_aDeadline = []       # heap of (deadline, sid); may be early (sid used since), never late
+        self.m_sIdle = 0
+        self.m_sAbsolute = 0
+        self.m_cExpired = 0
+        self.m_fnSessionUnused = None
+        self.m_lock = threading.Lock()
+
+    def SetTimeouts(self, sIdle, sAbsolute):
+        """Expire sids unused for sIdle seconds, or sAbsolute seconds after login (0 = never)"""
+
+        self.m_sIdle = sIdle
+        self.m_sAbsolute = sAbsolute
+
+    def SetOnSessionUnused(self, fn):
+        """fn(session) is called (without the lock held) when a session's last sid expires"""
+
+        self.m_fnSessionUnused = fn
+
+    def StartReaper(self, sSweep):
+        thread = threading.Thread(target=self.RunReaper, args=(sSweep,), name='sid-reaper', daemon=True)
+        thread.start()
+
+    def RunReaper(self, sSweep):
+        while True:
+            time.sleep(sSweep)
+            self.Sweep()
+
+    def SDeadline(self, sid):
+        """When sid expires, or None if it never does (m_lock must be held)"""
+
+        lS = []
+        if self.m_sIdle:
+            lS.append(self.m_mpSidSUsed[sid] + self.m_sIdle)
+        if self.m_sAbsolute:
+            lS.append(self.m_mpSidSCreated[sid] + self.m_sAbsolute)
+
+        return min(lS) if lS else None
+
+    def SessionFromSid(self, sid):
+        """Returns the session for sid, or None if sid isn't (or is no longer) valid. Counts as a use
+        of the sid for idle timeout purposes."""
+
+        # the deadline check reads, and the touch writes, maps that revocation and Sweep change
+        #  together, so all of it happens under the lock (a touch after a revoke would also leave
+        #  an m_mpSidSUsed entry behind for good)
+
+        with self.m_lock:
+            session = self.m_mpSidSession.get(sid)
+            if session is None:
+                return None
+
+            sNow = time.monotonic()
+            sDeadline = self.SDeadline(sid)
+            if sDeadline is not None and sNow >= sDeadline:
+                # expired but not swept yet
+                return None
+
+            self.m_mpSidSUsed[sid] = sNow
+            return session
+
+    def CSid(self):
+        return len(self.m_mpSidSession)
+
+    def SidGenerateLocked(self):
+        """Generate a new unused SID (m_lock must be held)"""
+
+        # Seems like the loop should be completely unnecessary, but also shouldn't
+        #  really hurt anything to have it
+
+        while True:
+            sid = secrets.token_hex(nbytes=16)
+            if sid not in self.m_mpSidSession:
+                return sid
+
+    def SidRegister(self, session, fRevokeOthers=True):
+        """Create and return a new sid for session, by default revoking any sids it already had"""
+
+        with self.m_lock:
+            if fRevokeOthers:
+                self.RevokeSessionLocked(session)
+
+            sid = self.SidGenerateLocked()
+            sNow = time.monotonic()
+            self.m_mpSidSession[sid] = session
+            self.m_mpSidSCreated[sid] = sNow
+            self.m_mpSidSUsed[sid] = sNow
+            setSid = self.m_mpSessionSetSid.setdefault(session, set())
+            setSid.add(sid)
+            session.m_cSidLive = len(setSid)
+
+            sDeadline = self.SDeadline(sid)
+            if sDeadline is not None:
+                heapq.heappush(self.m_aDeadline, (sDeadline, sid))
+
+            return sid
+
+    def RevokeLocked(self, sid):
+        """Forget sid; returns the session it pointed at, or None (m_lock must be held)"""
+
+        session = self.m_mpSidSession.pop(sid, None)
+        if session is None:
+            return None
+
+        del self.m_mpSidSCreated[sid]
+        del self.m_mpSidSUsed[sid]
+
+        setSid = self.m_mpSessionSetSid[session]
+        setSid.discard(sid)
+        session.m_cSidLive = len(setSid)
+        if not setSid:
+            del self.m_mpSessionSetSid[session]
+
+        return session
+
+    def RevokeSessionLocked(self, session):
+        """Forget every sid pointing at session (m_lock must be held)"""
+
+        for sid in self.m_mpSessionSetSid.pop(session, ()):
+            del self.m_mpSidSession[sid]
+            del self.m_mpSidSCreated[sid]
+            del self.m_mpSidSUsed[sid]
+        session.m_cSidLive = 0
+
+    def Sweep(self):
+        """Expire every sid that is past its deadline. Entries for sids used since they were pushed
+        are pushed again with their new deadline, so each sid costs O(log n) per sweep it survives
+        past its original deadline, and nothing for sids that aren't due."""
+
+        lSessionUnused = []
+        sNow = time.monotonic()
+
+        with self.m_lock:
+            while self.m_aDeadline and self.m_aDeadline[0][0] <= sNow:
+                _, sid = heapq.heappop(self.m_aDeadline)
+                if sid not in self.m_mpSidSession:
+                    continue    # revoked already
+
+                sDeadline = self.SDeadline(sid)
+                if sDeadline is not None and sDeadline > sNow:
+                    heapq.heappush(self.m_aDeadline, (sDeadline, sid))
+                    continue
+
+                session = self.RevokeLocked(sid)
+                self.m_cExpired += 1
+                if session.m_cSidLive == 0:
+                    lSessionUnused.append(session)
+
+        if self.m_fnSessionUnused is not None:
+            for session in lSessionUnused:
+                self.m_fnSessionUnused(session)
+
+class SharedSidRegistry(SidRegistry):
+    """SidRegistry kept in a SQLite table rather than in memory, so that every worker process (see
+    main.py --workers) sees the same sids. A sid maps to a uid, and the session itself comes from
+    the group (which reads it from the shared store). Times are wall clock, since they're compared
+    across processes."""
+
+    s_sUseGranularity = 30.0    # last-use times are only rewritten when this much older
+
+    def __init__(self, path, group):
+        super().__init__()
+        self.m_group = group
+
+        # autocommit mode: every statement is its own transaction, visible to the other workers at once
+
+        self.m_conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.m_conn.execute('PRAGMA journal_mode=WAL')
+        self.m_conn.execute(
+                'CREATE TABLE IF NOT EXISTS sids ('
+                'sid TEXT PRIMARY KEY, uid TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL) WITHOUT ROWID')
+        self.m_conn.execute('CREATE INDEX IF NOT EXISTS sids_uid ON sids (uid)')
+
+    def FExpired(self, sCreated, sUsed, sNow):
+        if self.m_sIdle and sNow >= sUsed + self.m_sIdle:
+            return True
+        return bool(self.m_sAbsolute and sNow >= sCreated + self.m_sAbsolute)
+
+    def SessionFromSid(self, sid):
+        with self.m_lock:
+            row = self.m_conn.execute('SELECT uid, created, used FROM sids WHERE sid = ?', (sid,)).fetchone()
+
+        if row is None:
+            return None
+
+        uid, sCreated, sUsed = row
+        sNow = time.time()
+        if self.FExpired(sCreated, sUsed, sNow):
+            return None
+
+        if sNow - sUsed >= self.s_sUseGranularity:
+            with self.m_lock:
+                self.m_conn.execute('UPDATE sids SET used = ? WHERE sid = ?', (sNow, sid))
+
+        return self.m_group.SessionFromUid(uid)
+
+    def CSid(self):
+        with self.m_lock:
+            return self.m_conn.execute('SELECT COUNT(*) FROM sids').fetchone()[0]
+
+    def SidRegister(self, session, fRevokeOthers=True):
+        sNow = time.time()
+
+        with self.m_lock:
+            self.m_conn.execute('BEGIN IMMEDIATE')
+            try:
+                if fRevokeOthers:
+                    self.m_conn.execute('DELETE FROM sids WHERE uid = ?', (session.m_uid,))
+
+                while True:
+                    sid = secrets.token_hex(nbytes=16)
+                    cur = self.m_conn.execute(
+                            'INSERT OR IGNORE INTO sids (sid, uid, created, used) VALUES (?, ?, ?, ?)',
+                            (sid, session.m_uid, sNow, sNow))
+                    if cur.rowcount == 1:
+                        break
+
+                self.m_conn.execute('COMMIT')
+            except BaseException:
+                self.m_conn.execute('ROLLBACK')
+                raise
+
+        return sid
+
+    def Sweep(self):
+        # sessions aren't cached in shared mode, so there's never anything to tell the group about
+
+        sNow = time.time()
+        with self.m_lock:
+            cur = self.m_conn.execute(
+                    'DELETE FROM sids WHERE (? > 0 AND used + ? <= ?) OR (? > 0 AND created + ? <= ?)',
+                    (self.m_sIdle, self.m_sIdle, sNow, self.m_sAbsolute, self.m_sAbsolute, sNow))
+            self.m_cExpired += cur.rowcount
+
 class Server:
     """High level wrapper for the http server, tracking various important bits"""
 
     s_strPathImage = '/image'
+    s_strCacheControlImage = 'public, max-age=3600'
+
+    s_mpStrExtStrContent = {
+            '.gif' : 'image/gif',
+            '.jpeg' : 'image/jpeg',
+            '.jpg' : 'image/jpeg',
+            '.png' : 'image/png',
+        }
+    s_lStrEngine = ['threading', 'asyncio']
+
+    # POST routes that may wait on the credential pool (engines shouldn't run these inline on
+    #  anything shared, like an event loop)
+
+    s_setPathPostSlow = {'/create', '/login'}
+
+    # our forms post a few short fields, so anything much bigger isn't from us
+
+    s_cBPostMax = 16 * 1024
+    s_sPostTimeout = 10.0
+
+    # times a move is redone when other requests keep saving the same (shared) session first
+
+    s_cTrySaveShared = 10
 
     def __init__(self):
         self.m_rooms = None
         self.m_group = None
-        self.m_mpSidSession = {}
+        self.m_sidreg = SidRegistry()
+        self.m_imagecache = imagecache.ImageCache(64 * 1024 * 1024, 1024 * 1024)
+        self.m_mpMethodRouteLabels = {}
+        self.m_profiler = None
+        self.m_cBPostMax = self.s_cBPostMax
+        self.m_sPostTimeout = self.s_sPostTimeout
+
+        # pages that never change are built (and compressed) once, here
+
+        self.m_pageLogin = contentcoding.g_coder.PageStatic(self.AbPageLogin())
+        self.m_pageCreate = contentcoding.g_coder.PageStatic(self.AbPageCreate())
+        self.m_pageRedirect = contentcoding.g_coder.PageStatic(self.AbPageRedirect())
+        self.m_pageBusy = contentcoding.g_coder.PageStatic(self.AbPageBusy())
+
         global g_server
         g_server = self
 
@@ -108,69 +436,165 @@ class Server:
                 "/create" : self.OnGetCreate,
                 "/favicon.ico" : self.OnGetFavicon,
                 "/login" : self.OnGetLogin,
+                "/metrics" : self.OnGetMetrics,
                 self.s_strPathImage : self.OnGetImage,
                 }
 
+        # gauges are read at scrape time, so they follow SetGroup/SetSidRegistry/etc.
+
+        g_metrics = metrics.g_metrics
+        g_metrics.SetGauge('webadv_sids_live', "Sids currently valid", lambda: self.m_sidreg.CSid())
+        g_metrics.SetGauge('webadv_sids_expired_total', "Sids expired by the reaper",
+                           lambda: self.m_sidreg.m_cExpired, 'counter')
+        g_metrics.SetGauge('webadv_sessions_loaded', "Sessions held in memory",
+                           lambda: len(self.m_group.m_mpUidSession) if self.m_group else 0)
+        g_metrics.SetGauge('webadv_sessions_evicted_total', "Idle sessions dropped from memory",
+                           lambda: self.m_group.m_cEvicted if self.m_group else 0, 'counter')
+        g_metrics.SetGauge('webadv_dirty_queue', "Sessions waiting for a write-behind save",
+                           lambda: self.m_group.m_flusher.CDirty() if self.m_group and self.m_group.m_flusher else 0)
+        g_metrics.SetGauge('webadv_sessions_flushed_total', "Sessions saved by the write-behind flusher",
+                           lambda: self.m_group.m_flusher.m_cFlushed if self.m_group and self.m_group.m_flusher else 0, 'counter')
+        g_metrics.SetGauge('webadv_dirty_lag_seconds', "Age of the oldest change waiting for a write-behind save",
+                           lambda: self.m_group.m_flusher.SLag() if self.m_group and self.m_group.m_flusher else 0)
+        g_metrics.SetGauge('webadv_image_cache_bytes', "Bytes of image data cached in memory",
+                           lambda: self.m_imagecache.m_cB)
+
     def SetRooms(self, rooms):
         self.m_rooms = rooms
 
+    def SetSidRegistry(self, sidreg):
+        """Replace the in-memory sid registry (e.g. with a SharedSidRegistry); call before SetGroup"""
+
+        self.m_sidreg = sidreg
+
     def SetGroup(self, group):
         self.m_group = group
 
-    def Run(self):
-        addr = ('', 8000)   # all interfaces, port 8000
-        ths = Hs.ThreadingHTTPServer(addr, Handler)
-        ths.serve_forever()
+        # sessions whose sids have all expired can be dropped from memory if they're clean
 
-    def FIsValidSid(self, sid):
-        if self.m_mpSidSession.get(sid) is None:
-            return False
+        self.m_sidreg.SetOnSessionUnused(group.DropIfIdle)
 
-        # TODO: some notion of sid timeout?
+    def SetImageCache(self, cBMax, cBEntryMax):
+        """Keep up to cBMax bytes of images in memory; files over cBEntryMax are streamed from disk"""
 
-        return True
+        self.m_imagecache = imagecache.ImageCache(cBMax, cBEntryMax)
 
-    def SidGenerate(self):
-        """Generate a new unused SID"""
+    def SetProfiler(self, profiler):
+        """Run every request's dispatch under profiler (a tracing.Profiler)"""
 
-        # Seems like the loop should be completely unnecessary, but also shouldn't
-        #  really hurt anything to have it
+        self.m_profiler = profiler
 
-        while True:
-            sid = secrets.token_hex(nbytes=16)
-            if sid not in self.m_mpSidSession:
-                return sid
+    def SetPostLimits(self, cBMax, sTimeout):
+        """Reject POST bodies over cBMax bytes, or that take more than sTimeout seconds to arrive"""
+
+        self.m_cBPostMax = cBMax
+        self.m_sPostTimeout = sTimeout
+
+    def SetSidTimeouts(self, sIdle, sAbsolute):
+        """Expire sids after sIdle seconds unused or sAbsolute seconds after login (0 = never)"""
+
+        self.m_sidreg.SetTimeouts(sIdle, sAbsolute)
+
+        lS = [s for s in (sIdle, sAbsolute) if s]
+        if lS:
+            self.m_sidreg.StartReaper(min(min(lS) / 4, 30.0))
+
+    def Run(self, strEngine='threading', port=8000, sock=None):
+        """Serve forever on all interfaces using the requested engine (see s_lStrEngine). If sock is
+        given, it is an already listening socket (shared with other workers) to serve on instead."""
+
+        addr = ('', port)
+
+        if strEngine == 'asyncio':
+            # one event loop, no thread per connection, keep-alive supported
+            engine = asyncengine.AsyncEngine(self)
+            engine.Run(addr, sock)
+        elif sock is not None:
+            ths = Hs.ThreadingHTTPServer(addr, Handler, bind_and_activate=False)
+            ths.socket.close()
+            ths.socket = sock
+            ths.server_address = sock.getsockname()
+            ths.serve_forever()
+        else:
+            ths = Hs.ThreadingHTTPServer(addr, Handler)
+            ths.serve_forever()
+
+    def SidGenerate(self, session):
+        """Generate a new unused SID for session (revoking any it had before)"""
+
+        return self.m_sidreg.SidRegister(session)
+
+    def StrLabelsRoute(self, command, path):
+        """Metric labels for a request; anything that isn't a known route is lumped together, so
+        random paths can't create unbounded label sets"""
+
+        mpPathFn = self.m_mpPathGet if command == 'GET' else self.m_mpPathPost
+        if path in mpPathFn:
+            route = path
+        elif command == 'GET' and path.startswith(self.s_strPathImage + '/'):
+            route = self.s_strPathImage
+        else:
+            route = 'other'
+
+        strLabels = self.m_mpMethodRouteLabels.get((command, route))
+        if strLabels is None:
+            strLabels = 'method="{m}",route="{r}"'.format(m=command, r=route)
+            self.m_mpMethodRouteLabels[(command, route)] = strLabels
+
+        return strLabels
 
     def HandlePost(self, handler):
         """Dispatch an HTTP POST request to the appropriate place"""
 
-        # Expectation:
-        #  - post data will be URL encoded (i.e., key=value&key=value&...)
-        #  - above should be true since default for form is "enctype=application/x-www-form-urlencoded"
-        #  - NOTE spaces are switched to + and special characters are converted to ASCII HEX
+        self.DispatchInstrumented('POST', self.DispatchPost, handler)
+
+    def HandleGet(self, handler):
+        """Dispatch an HTTP GET request to the appropriate place"""
+
+        self.DispatchInstrumented('GET', self.DispatchGet, handler)
+
+    def DispatchInstrumented(self, command, fnDispatch, handler):
+        """Run fnDispatch(handler), recording its latency, tracing it if sampled, and profiling it
+        if asked to"""
+
+        sStart = time.perf_counter()
+        trace = tracing.g_tracer.Begin('{c} {p}'.format(c=command, p=handler.path))
+        try:
+            if self.m_profiler is not None:
+                self.m_profiler.Run(fnDispatch, handler)
+            else:
+                fnDispatch(handler)
+        finally:
+            tracing.g_tracer.End(trace)
+            metrics.g_metrics.Observe(
+                    'webadv_request_seconds', self.StrLabelsRoute(command, handler.path), time.perf_counter() - sStart)
+
+    def DispatchPost(self, handler):
+        """Dispatch an HTTP POST request to the appropriate place"""
 
-        # redirect if we don't understand where the post is
+        # redirect if we don't understand where the post is; its body is left unread, so the
+        #  connection can't be used for another request
 
         fn = self.m_mpPathPost.get(handler.path)
         if fn is None:
+            handler.close_connection = True
             self.OnRedirectLogin(handler)
+            return
 
-        # extract and convert post data if possible
-
-        strCl = 'Content-Length'
-        dPost = {}
-        if strCl in handler.headers:
-            cB = int(handler.headers[strCl])
-            strPost = handler.rfile.read(cB).decode()
-            for strKvp in strPost.split('&'):
-                k,v = strKvp.split('=')
-                dPost[k] = v
+        # Post data is URL encoded (key=value&key=value&..., the default enctype for forms); it's
+        #  read and decoded here, so routes get plain strings, and anything we won't take is turned
+        #  away before a route or session sees it
 
-        # TODO think about wrapping in try/except to make more armored maybe?
+        try:
+            dPost = formdata.DPostRead(handler, self.m_cBPostMax, self.m_sPostTimeout)
+        except formdata.FormError as err:
+            handler.log_error('Rejected POST to %s: %s', handler.path, err)
+            self.OnPostRejected(handler, err)
+            return
 
         fn(handler, dPost)
 
-    def HandleGet(self, handler):
+    def DispatchGet(self, handler):
         """Dispatch an HTTP GET request to the appropriate place"""
 
         fn = self.m_mpPathGet.get(handler.path)
@@ -193,6 +617,9 @@ class Server:
     def OnRedirectLogin(self, handler):
         # generate 303 return sending people to GET the /login endpoint
 
+        contentcoding.g_coder.Send(handler, 303, self.m_pageRedirect, [('Location', '/login')])
+
+    def AbPageRedirect(self):
         lStr = [
                 '<html>',
                 '<body>',
@@ -202,14 +629,7 @@ class Server:
                 '</html>',
             ]
         strOut = '\n'.join(lStr)
-        abOut = strOut.encode()
-
-        handler.send_response(303)
-        handler.send_header('Location', '/login')
-        handler.send_header('Content-Length', len(abOut))
-        handler.end_headers()
-
-        handler.wfile.write(abOut)
+        return strOut.encode()
 
     def OnCreateError(self, handler, strErr):
         """Provide error page to the user in response to bad user create attempts"""
@@ -228,11 +648,50 @@ class Server:
         strOut = '\n'.join(lStr)
         abOut = strOut.encode()
 
-        handler.send_response(200)
-        handler.send_header('Content-Length', len(abOut))
-        handler.end_headers()
+        contentcoding.g_coder.Send(handler, 200, abOut)
+
+    def OnPostRejected(self, handler, err):
+        """Answer a POST whose body we wouldn't read or couldn't decode (err is a formdata.FormError)"""
+
+        metrics.g_metrics.Count('webadv_post_rejected_total', 'code="{c}"'.format(c=err.m_code))
+
+        lStr = [
+                '<html>',
+                '<head><title>Bad Request</title></head>',
+                '<body>',
+                '<h1>Oops!</h1>',
+                '<p>That request could not be handled.</p>',
+                '<p>You could go back to <a href="/login">log in</a> again.</p>',
+                '</body>',
+                '</html>',
+            ]
+        strOut = '\n'.join(lStr)
+        abOut = strOut.encode()
+
+        # whatever is left of the body is still on the connection, so it has to go
+
+        handler.close_connection = True
+        contentcoding.g_coder.Send(handler, err.m_code, abOut, [('Connection', 'close')])
 
-        handler.wfile.write(abOut)
+    def OnBusy(self, handler):
+        """Tell the user we're too busy right now (credential pool is full, or their session is too
+        contended to save) and to try again"""
+
+        contentcoding.g_coder.Send(handler, 503, self.m_pageBusy, [('Retry-After', 1)])
+
+    def AbPageBusy(self):
+        lStr = [
+                '<html>',
+                '<head><title>Busy</title></head>',
+                '<body>',
+                '<h1>Busy!</h1>',
+                '<p>Lots of people are logging in right now. Please wait a moment and try again.</p>',
+                '<p>You could go back to <a href="/login">log in</a> again.</p>',
+                '</body>',
+                '</html>',
+            ]
+        strOut = '\n'.join(lStr)
+        return strOut.encode()
 
     def OnPostCreate(self, handler, dPost):
         """Handles attempts to create a new account"""
@@ -279,20 +738,29 @@ class Server:
 
         # create a session with the given user/password
 
-        session = self.m_group.SessionCreate()
-        session.SetCreds(uid, pwd1)
-        session.SetPath(os.path.join(self.m_group.m_pathDir, "{u}.session".format(u=uid)))
-        session.SetRoomCur(self.m_rooms.m_roomStart)
+        sessionNew = self.m_group.SessionCreate()
+        try:
+            sessionNew.SetCreds(uid, pwd1)
+        except session.CredBusyError:
+            self.OnBusy(handler)
+            return
+
+        sessionNew.SetPath(os.path.join(self.m_group.m_pathDir, "{u}.session".format(u=uid)))
+        sessionNew.SetRoomCur(self.m_rooms.m_roomStart)
 
-        strErr = session.StrErrors()
+        strErr = sessionNew.StrErrors()
         if strErr:
             self.OnCreateError(handler, "Error creating user: " + strErr)
             return
 
-        # stamp the session to disk and add to the group
+        # claim the uid in the group, then stamp the session to disk; the check above is only a
+        #  shortcut, since someone else may be creating the same user right now
+
+        if not self.m_group.FAddSession(sessionNew):
+            self.OnCreateError(handler, "User already exists")
+            return
 
-        session.Save()
-        self.m_group.AddSession(session)
+        sessionNew.Save()
 
         # pretend that the user just logged in
 
@@ -306,6 +774,9 @@ class Server:
     def OnGetCreate(self, handler):
         """Page to allow a new player to create a new account"""
 
+        contentcoding.g_coder.Send(handler, 200, self.m_pageCreate)
+
+    def AbPageCreate(self):
         lStr = [
                 '<html>',
                 '<head><title>New Player</title></head>',
@@ -328,51 +799,54 @@ class Server:
                 '</html>',
             ]
         strOut = '\n'.join(lStr)
-        abOut = strOut.encode()
-
-        handler.send_response(200)
-        handler.send_header('Content-Length', len(abOut))
-        handler.end_headers()
-        handler.wfile.write(abOut)
+        return strOut.encode()
 
     def OnPostLogin(self, handler, dPost):
         """Handle the submit end of attempting to log in"""
 
-        handler.send_response(200)
-        handler.end_headers()
-        
-        lStr = []
-        lStr.append('<html>')
-        lStr.append('<body>')
-
         # Check if we have a user and password that match. To avoid timing attacks we check
         #  a session, even if we don't have one with a matching UID.
 
-        sessionCheck = self.m_group.SessionFromUid(dPost.get('login'))
+        # the session is pinned in memory until its sid is registered, so a session cache can't
+        #  evict it while the password is hashed and leave the sid pointing at a stale copy
+
+        sessionCheck = self.m_group.SessionPinFromUid(dPost.get('login'))
+        fPinned = sessionCheck is not None
         if sessionCheck is None:
             sessionCheck = self.m_group.SessionCreate()
 
-        if not sessionCheck.FMatchesCreds(dPost.get('pass')):
-            lStr.append('<h1>Invalid Login</h1>')
-            lStr.append('<p>The user or password you supplied do not match our records.</p>')
-            lStr.append('<p>You could try to <a href="/login">login again</a> if you would like.</p>')
-            lStr.append('<p>You could also try to <a href="/create">create a new account</a> instead.</p>')
-        else:
-            # for safety, wipe any other sids that are pointing to this session
+        try:
+            try:
+                fMatches = sessionCheck.FMatchesCreds(dPost.get('pass'))
+                if not fMatches:
+                    fMatches = sessionCheck.FMigrateEncodedCreds(dPost.get('pass'))
+                    if fMatches:
+                        # if that loses a race with another save (when shared), the password is
+                        #  just migrated again at the next login
 
-            lSidRemove = []
-            for sidOther, session in self.m_mpSidSession.items():
-                if session == sessionCheck:
-                    lSidRemove.append(sidOther)
+                        self.m_group.FSaveSession(sessionCheck)
+            except session.CredBusyError:
+                self.OnBusy(handler)
+                return
 
-            for sidOther in lSidRemove:
-                del self.m_mpSidSession[sidOther]
+            # generate sid and map it to this session (for safety, wiping any other sids that are
+            #  pointing to this session)
 
-            # generate sid and map it to this session
+            sid = self.SidGenerate(sessionCheck) if fMatches else None
+        finally:
+            if fPinned:
+                self.m_group.Unpin(sessionCheck)
 
-            sid = self.SidGenerate()
-            self.m_mpSidSession[sid] = sessionCheck
+        lStr = []
+        lStr.append('<html>')
+        lStr.append('<body>')
 
+        if not fMatches:
+            lStr.append('<h1>Invalid Login</h1>')
+            lStr.append('<p>The user or password you supplied do not match our records.</p>')
+            lStr.append('<p>You could try to <a href="/login">login again</a> if you would like.</p>')
+            lStr.append('<p>You could also try to <a href="/create">create a new account</a> instead.</p>')
+        else:
             # send back welcome page
 
             lStr.append('<h1>Login Successful!</h1>')
@@ -388,10 +862,12 @@ class Server:
 
         lStr.append('</body>')
         lStr.append('</html>')
+        lStr.append('')
+
+        strOut = '\n'.join(lStr)
+        abOut = strOut.encode()
 
-        for str0 in lStr:
-            handler.wfile.write(str0.encode())
-            handler.wfile.write('\n'.encode())
+        contentcoding.g_coder.Send(handler, 200, abOut)
 
     def OnPostRoom(self, handler, dPost):
         """Handle the submit end of attempting to access a room"""
@@ -406,21 +882,41 @@ class Server:
             self.OnRedirectLogin(handler)
             return
 
-        sid = dPost['sid']
-        if not self.FIsValidSid(sid):
-            handler.log_error('Invalid sid "{sid}" given'.format(sid=sid))
-            self.OnRedirectLogin(handler)
-            return
+        # one lookup both validates the sid and finds its session (with a shared registry, each
+        #  lookup is a query plus a session load)
 
-        session = self.m_mpSidSession.get(sid, None)
+        sid = dPost['sid']
+        session = self.m_sidreg.SessionFromSid(sid)
         if session is None:
-            handler.log_error('Sid "{sid}" valid but no session?'.format(sid=sid))
+            handler.log_error('Invalid sid "{sid}" given'.format(sid=sid))
             self.OnRedirectLogin(handler)
             return
 
         # do the actual work, on the session, to possibly adjust and then display the current room
 
         session.TryAdjustRoom(dPost, handler)
+
+        # when shared, this request has its own copy of the session, so the move is committed
+        #  before it's shown; if another request (another tab, another worker) saved the session
+        #  since we read it, the move is redone on top of what they saved
+
+        if self.m_group.m_fShared:
+            cTry = 1
+            while session.m_fIsDirty and not self.m_group.FSaveSession(session):
+                if cTry >= self.s_cTrySaveShared:
+                    handler.log_error('Session "{uid}" changed under us {c} times, giving up'.format(uid=session.m_uid, c=cTry))
+                    self.OnBusy(handler)
+                    return
+
+                session = self.m_group.SessionFromUid(session.m_uid)
+                if session is None:
+                    handler.log_error('Sid "{sid}" session vanished'.format(sid=sid))
+                    self.OnRedirectLogin(handler)
+                    return
+
+                session.TryAdjustRoom(dPost, handler)
+                cTry += 1
+
         room = session.RoomCur()
         if room is None:
             handler.log_error('Sid "{sid}" session "{uid}" had no current room'.format(sid=sid, uid=session.m_uid))
@@ -430,11 +926,14 @@ class Server:
         session.RenderRoomCur(sid, handler)
 
         if session.m_fIsDirty:
-            session.Save()
+            self.m_group.FSaveSession(session)
 
     def OnGetLogin(self, handler):
         """Provide the initial login page"""
 
+        contentcoding.g_coder.Send(handler, 200, self.m_pageLogin)
+
+    def AbPageLogin(self):
         lStr = [
                 '<html>',
                 '<head><title>Login</title></head>',
@@ -459,18 +958,12 @@ class Server:
                 '</html>',
             ]
         strOut = '\n'.join(lStr)
-        abOut = strOut.encode()
-
-        handler.send_response(200)
-        handler.send_header('Content-Length', len(abOut))
-        handler.end_headers()
-        handler.wfile.write(abOut)
+        return strOut.encode()
 
     def OnGetFavicon(self, handler):
         """Favicon handling"""
 
-        handler.send_response(404)
-        handler.end_headers()
+        contentcoding.g_coder.Send(handler, 404, b'')
 
     def OnGetImage(self, handler):
         """Support providing images"""
@@ -479,52 +972,87 @@ class Server:
 
         strPathImage = handler.path[len(self.s_strPathImage) + 1:]
 
-        # See if the image exists -- if not, that's a 404
+        # Determine particular image type -- we support png, jpeg, and gif for now
+
+        strExt = os.path.splitext(strPathImage)[-1]
+        strContent = self.s_mpStrExtStrContent.get(strExt.lower(), None)
 
-        if not os.path.exists(strPathImage):
-            handler.send_response(404)
-            handler.end_headers()
+        if strContent is None:
+            contentcoding.g_coder.Send(handler, 404, b'')
             return
 
-        # Determine particular image type -- we support png, jpeg, and gif for now
+        # Look up the image data (cached unless the file changed); no file means a 404
 
-        s_mpStrExtStrContent = {
-                '.gif' : 'image/gif',
-                '.jpeg' : 'image/jpeg',
-                '.jpg' : 'image/jpeg',
-                '.png' : 'image/png',
-            }
+        entry = self.m_imagecache.Entry(strPathImage)
+        if entry is None:
+            contentcoding.g_coder.Send(handler, 404, b'')
+            return
 
-        strExt = os.path.splitext(strPathImage)[-1]
-        strContent = s_mpStrExtStrContent.get(strExt.lower(), None)
+        # If the browser already has this version, tell it so rather than sending it again
 
-        if strContent is None:
-            handler.send_response(404)
-            handler.end_headers()
+        if entry.FNotModified(handler.headers):
+            contentcoding.g_coder.Send(handler, 304, None, self.LPairImageValidators(entry))
+            return
+
+        # Work out how much of it to send (Range requests get a 206 with just that part)
+
+        rangeB = None
+        if entry.FRangeApplies(handler.headers):
+            rangeB = imagecache.RangeParse(handler.headers.get('Range'), entry.m_cB)
+
+        if rangeB is False:
+            contentcoding.g_coder.Send(handler, 416, b'', [('Content-Range', 'bytes */{c}'.format(c=entry.m_cB))])
             return
 
-        # Load up the image data
+        lPairHeader = self.LPairImageValidators(entry)
+        if rangeB is None:
+            code = 200
+            iBStart, cB = 0, entry.m_cB
+        else:
+            code = 206
+            iBStart, cB = rangeB
+            lPairHeader.append(('Content-Range', 'bytes {s}-{e}/{c}'.format(s=iBStart, e=iBStart + cB - 1, c=entry.m_cB)))
+
+        # Small images come from memory; big ones go from disk straight to the socket (opened
+        #  first, so a file that has gone away can still get a 404). Images are compressed already,
+        #  and ranges are of the image as is, so neither is content coded.
+
+        if entry.m_aB is not None:
+            contentcoding.g_coder.Send(
+                    handler, code, memoryview(entry.m_aB)[iBStart:iBStart + cB], lPairHeader,
+                    strContentType=strContent, fCompress=False)
+        else:
+            try:
+                fileIn = open(strPathImage, 'rb')
+            except OSError as err:
+                handler.log_error('Could not open image "%s": %s', strPathImage, err)
+                contentcoding.g_coder.Send(handler, 404, b'')
+                return
+
+            contentcoding.g_coder.SendFile(handler, code, fileIn, iBStart, cB, lPairHeader, strContentType=strContent)
+
+        metrics.g_metrics.Count('webadv_image_bytes_total', '', cB)
 
-        # BB (davidm) any kind of error handling we want here?
+    def OnGetMetrics(self, handler):
+        """Counters, gauges and latency histograms for this process, for Prometheus to scrape"""
 
-        with open(strPathImage, 'rb') as fileIn:
-            aBImage = fileIn.read()
+        abOut = metrics.g_metrics.StrExposition().encode()
 
-        # Send a successful response with the image content
+        contentcoding.g_coder.Send(handler, 200, abOut, strContentType='text/plain; version=0.0.4; charset=utf-8')
 
-        handler.send_response(200)
-        handler.send_header('Content-type', strContent)
-        handler.send_header('Content-Length', len(aBImage))
-        handler.end_headers()
-        handler.wfile.write(aBImage)
+    def LPairImageValidators(self, entry):
+        return [
+                ('ETag', entry.m_strEtag),
+                ('Last-Modified', entry.m_strLastModified),
+                ('Cache-Control', self.s_strCacheControlImage),
+                ('Accept-Ranges', 'bytes'),
+            ]
 
     def FormExample(self, handler, lPart):
         """Example of doing form stuff, useful while experimenting with things"""
 
         # show login form
-        handler.send_response(200)
-        handler.end_headers()
-        handler.wfile.write('''<html>
+        contentcoding.g_coder.Send(handler, 200, '''<html>
                 <head><title>Login</title></head>
                 <body>
                 <h1>Welcome</h1>
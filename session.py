@@ -1,14 +1,122 @@
 # session-related machinery (tracks player state)
 
 import collections
+import concurrent.futures
+import contentcoding
 import glob
 import hashlib
+import layout
+import metrics
+import multiprocessing
 import os
 import random
 import secrets
 import server
+import threading
+import time
+import tracing
+import urllib.parse
 import yaml
 
+class CredBusyError(Exception):
+    """Raised when the credential pool is too backed up to take on more hashing work"""
+    pass
+
+def InitCredWorker(lFdClose):
+    """Pool worker startup: close descriptors it inherited but mustn't keep open (e.g. a listening
+    socket, which would otherwise stay bound for as long as the worker lives)"""
+
+    for fd in lFdClose:
+        os.close(fd)
+
+def StrHashPwd(algo, pwd, salt, cIter):
+    """PBKDF2 hash of pwd with salt, as hex (module level so it can run in a worker process)"""
+
+    return hashlib.pbkdf2_hmac(algo, pwd.encode(), salt.encode(), cIter).hex()
+
+class CredPool:
+    """Bounded pool of worker processes that do password hashing off of the request threads"""
+
+    def __init__(self, cWorker, cQueueMax, lFdClose=()):
+        """lFdClose are descriptors the workers inherit (they're forked) and should close"""
+
+        if lFdClose:
+            self.m_executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=cWorker, mp_context=multiprocessing.get_context('fork'),
+                    initializer=InitCredWorker, initargs=(list(lFdClose),))
+        else:
+            self.m_executor = concurrent.futures.ProcessPoolExecutor(max_workers=cWorker)
+        self.m_semaQueue = threading.BoundedSemaphore(cQueueMax)
+
+        # start the workers now, before the http server has any threads running
+
+        self.m_executor.submit(int).result()
+
+    def StrHash(self, algo, pwd, salt, cIter):
+        """Hash in a worker process and wait for the result. Raises CredBusyError instead of
+        waiting if too many hashes are already queued or running."""
+
+        if not self.m_semaQueue.acquire(blocking=False):
+            raise CredBusyError()
+
+        try:
+            future = self.m_executor.submit(StrHashPwd, algo, pwd, salt, cIter)
+        except:
+            self.m_semaQueue.release()
+            raise
+
+        future.add_done_callback(lambda _: self.m_semaQueue.release())
+
+        return future.result()
+
+    def Shutdown(self):
+        self.m_executor.shutdown(cancel_futures=True)
+
+# pool used for credential hashing; None means hash inline on the calling thread
+
+g_credpool = None
+
+# libyaml's loader is many times faster than the pure python one, so use it when it's available
+
+LoaderYaml = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def DocLoadPath(path):
+    """Parse the yaml document in the file at path"""
+
+    with open(path, 'r') as fileIn:
+        return yaml.load(fileIn, Loader=LoaderYaml)
+
+def LDocLoadPaths(lPath):
+    """Parse a batch of session files (module level so it can run in a worker process)"""
+
+    return [DocLoadPath(path) for path in lPath]
+
+# Concurrency model (request threads, the flusher and the layout watcher all share these):
+#  - Rooms are never changed once loaded (lazily decoded rooms are published under the Rooms' own
+#    lock, and a reload swaps in a whole new Rooms), so they're read without locking
+#  - a Session is guarded by its stripe of g_lockstripes; moving, rendering, re-pointing after a
+#    reload and saving each hold it, so one player's requests (say, from two tabs) never interleave
+#  - when shared with other processes, every request reads its own copy of the session, so the
+#    stripes can't keep two requests apart; instead a save only lands if the stored version is
+#    still the one read (FSaveIfUnchanged), and a request that loses redoes its move on a fresh copy
+#  - Group's maps are changed only under Group.m_lockLoad, and registering a uid is a single
+#    check-and-add there (FAddSession), or in the store when it's shared with other processes
+
+class LockStripes:
+    """A fixed set of locks handed out by key hash, so every session can be locked without each one
+    carrying a lock of its own; keys that share a stripe just contend with each other a little.
+    The locks are reentrant, so a locked operation can call another (e.g. a move that saves)."""
+
+    s_cStripe = 64
+
+    def __init__(self, cStripe=s_cStripe):
+        self.m_aLock = [threading.RLock() for _ in range(cStripe)]
+
+    def Lock(self, key):
+        return self.m_aLock[hash(key) % len(self.m_aLock)]
+
+g_lockstripes = LockStripes()
+
 class Session:
     """Information about the state for a single player"""
 
@@ -23,27 +131,35 @@ class Session:
         self.m_roomSaved = None
         self.m_mpVarVal = collections.defaultdict(int)  # auto-create keys with 0 value
         self.m_fIsDirty = False
+        self.m_store = None         # None means a yaml file at m_path
+        self.m_docSaved = None      # last document written, so stores can write just the changes
+        self.m_cSidLive = 0         # sids pointing at us; we stay in memory while there are any
+        self.m_cPin = 0             # logins in progress (see Group.SessionPinFromUid); likewise
 
     def Load(self, path):
         """Serialize in this session from a file containing a yaml document"""
 
         self.m_path = path
 
-        with open(path, 'r') as fileIn:
-            doc = yaml.safe_load(fileIn)
-
+        doc = DocLoadPath(path)
         if doc is None:
             return
 
+        self.LoadDoc(doc)
+
+    def LoadDoc(self, doc):
+        """Fill in this session from a document (dict) as produced by DDoc"""
+
         self.m_uid = doc.get('uid')
         self.m_pwd = doc.get('pwd')
         self.m_roomSaved = doc.get('room')  # NOTE string, not room
         self.m_mpVarVal = collections.defaultdict(int)
         self.m_mpVarVal.update(doc.get('vars'))
+        self.m_docSaved = doc
         self.m_fIsDirty = False
 
-    def Save(self):
-        """Serialize out this session as a yaml document to its source path"""
+    def DDoc(self):
+        """Returns the document (dict) form of this session, as stored on disk"""
 
         # TODO: is there a better way here? can we fake that we're a dict instead somehow?
 
@@ -53,6 +169,66 @@ class Session:
         dSelf['room'] = self.m_room.m_name
         dSelf['vars'] = dict(self.m_mpVarVal)
 
+        return dSelf
+
+    def Lock(self):
+        """The lock guarding this session's state (shared with a few other sessions; see LockStripes)"""
+
+        return g_lockstripes.Lock(self.m_uid)
+
+    def Save(self):
+        """Serialize out this session to its store, or as a yaml document to its source path"""
+
+        # holding the lock throughout means saves of one session land in order and never share
+        #  the .new/.old files
+
+        with self.Lock():
+            self.SaveLocked()
+
+    def SaveLocked(self):
+        sStart = time.perf_counter()
+
+        dSelf = self.DDoc()
+
+        # clear dirty as soon as we have the snapshot, so that changes made while we're writing
+        #  (possible with write-behind) leave the session dirty for the next save; if the write
+        #  fails, it's still dirty
+
+        self.m_fIsDirty = False
+
+        try:
+            with tracing.g_tracer.Span('Session.Save'):
+                if self.m_store is not None:
+                    self.m_store.Save(dSelf, self.m_docSaved)
+                else:
+                    self.SaveYaml(dSelf)
+        except:
+            self.m_fIsDirty = True
+            raise
+
+        self.m_docSaved = dSelf
+
+        metrics.g_metrics.Observe('webadv_session_save_seconds', '', time.perf_counter() - sStart)
+
+    def FSaveIfUnchanged(self):
+        """Save to our (shared) store, but only if nobody has saved this session there since we
+        read it; returns False, leaving us dirty and unsaved, if someone has"""
+
+        with self.Lock():
+            dSelf = self.DDoc()
+
+            with tracing.g_tracer.Span('Session.Save'):
+                if not self.m_store.FSaveIfUnchanged(dSelf, self.m_docSaved):
+                    return False
+
+            self.m_docSaved = dSelf
+            self.m_fIsDirty = False
+
+        return True
+
+    def SaveYaml(self, dSelf):
+        """Write dSelf as a yaml document to our path, replacing the previous one"""
+
         tmp = self.m_path + ".new"
         with open(tmp, 'w') as fileOut:
             yaml.dump(dSelf, fileOut)
@@ -69,8 +245,6 @@ class Session:
         if os.path.exists(old):
             os.remove(old)
 
-        self.m_fIsDirty = False
-
     def StrErrors(self):
         """Validate this session, and if it has problems, return a string explaining the issues"""
 
@@ -79,7 +253,7 @@ class Session:
         if self.m_uid is None:
             lStrErr.append("UID is missing")
 
-        if self.m_path is None:
+        if self.m_path is None and self.m_store is None:
             lStrErr.append("UID {u} missing its path".format(u=self.m_uid))
 
         if self.m_roomSaved is None and self.m_room is None:
@@ -95,6 +269,29 @@ class Session:
     def RoomCur(self):
         return self.m_room
 
+    def ResolveRoom(self, rooms):
+        """Point at the actual room for the saved room name (after loading; doesn't make us dirty)"""
+
+        self.m_room = rooms.Room(self.m_roomSaved)
+
+    def RepointRoom(self, rooms):
+        """After a layout reload, move to the same-named room in rooms (doesn't make us dirty).
+        Returns False if rooms has no such room, in which case we stay in the old one."""
+
+        # locked so a move in progress isn't undone by re-pointing the room it moved from
+
+        with self.Lock():
+            roomCur = self.m_room
+            if roomCur is None or roomCur.m_strGen == rooms.m_strGen:
+                return True
+
+            roomNew = rooms.Room(roomCur.m_name)
+            if roomNew is None:
+                return False
+
+            self.m_room = roomNew
+            return True
+
     def SetRoomCur(self, room):
         self.m_room = room
         self.m_fIsDirty = True
@@ -109,21 +306,58 @@ class Session:
     def FMatchesCreds(self, pwd):
         """Returns True if the given user/password combo matches this session"""
 
+        sStart = time.perf_counter()
+
         hashSelf, salt = self.m_pwd.split(',')
-        dk = hashlib.pbkdf2_hmac(self.s_algoHash, pwd.encode(), salt.encode(), self.s_cIterHash)
-        hashCheck = dk.hex()
+        with tracing.g_tracer.Span('FMatchesCreds'):
+            hashCheck = self.StrHash(pwd, salt)
+
+        metrics.g_metrics.Observe('webadv_creds_check_seconds', '', time.perf_counter() - sStart)
 
         return hashSelf == hashCheck
 
+    def FMigrateEncodedCreds(self, pwd):
+        """Passwords used to be hashed as the browser sent them, form encoded, before POST bodies
+        were decoded. If pwd matches that way, switch the creds over to the decoded form (leaving
+        us dirty, to be saved) and return True."""
+
+        if not pwd:
+            return False
+
+        # exactly what browsers send: only letters, digits and *-._ are left alone
+
+        pwdEncoded = urllib.parse.quote_plus(pwd, safe='*').replace('~', '%7E')
+        if pwdEncoded == pwd:
+            return False
+
+        # checked even on the blank session that stands in for an unknown uid, so that a wrong
+        #  password takes as long whether or not the account exists
+
+        if not self.FMatchesCreds(pwdEncoded) or self.m_uid is None:
+            return False
+
+        with self.Lock():
+            self.SetCreds(self.m_uid, pwd)
+
+        return True
+
     def SetCreds(self, uid, pwd):
         """Sets the creds for this session object directly (assumes it is valid to do so)"""
 
-        self.m_uid = uid
         salt = secrets.token_hex(nbytes=32)
-        dk = hashlib.pbkdf2_hmac(self.s_algoHash, pwd.encode(), salt.encode(), self.s_cIterHash)
-        self.m_pwd = ','.join([dk.hex(), salt])
+        hashPwd = self.StrHash(pwd, salt)
+        self.m_uid = uid
+        self.m_pwd = ','.join([hashPwd, salt])
         self.m_fIsDirty = True
 
+    def StrHash(self, pwd, salt):
+        """Hash the password via the credential pool if there is one (may raise CredBusyError)"""
+
+        if g_credpool is None:
+            return StrHashPwd(self.s_algoHash, pwd, salt, self.s_cIterHash)
+
+        return g_credpool.StrHash(self.s_algoHash, pwd, salt, self.s_cIterHash)
+
     def SetPath(self, path):
         """Sets up the path for where this session should be saved"""
 
@@ -132,28 +366,13 @@ class Session:
 
     def StrFormatSmart(self, strIn):
         """Do "smart" formatting of strIn (expected to be a format string) vs. the contents of
-        mp_mpVarValue. In particular, deal with cases where the format string talks about items
-        that don't have keys in the var map."""
+        m_mpVarVal: variables the session doesn't have format as 0. Room text is parsed once at
+        layout load instead (see layout.Text); this is for anything else."""
 
-        # NOTE: I attempted to deal with this by using defaultdict, but unfortunately, the ** expansion
-        #  that is used to convert dictionaries into keyword expansions of course doesn't default expand
-        #  every possible keyword out, so defaultdict didn't actually help with that case at all. Since
-        #  there isn't a way to pass a "smart" dictionary like that into str.format(), we deal with that
-        #  ourselves here.
-
-        # TODO: be smarter/safer about dealing with this stuff -- doing the simple version where we detect
-        #  problems and fix them, rather than attempting to "correctly" parse the format syntax up front
-
-        cIter = 100
-        while cIter > 0:
-            cIter -= 1
-            try:
-                return strIn.format(**self.m_mpVarVal)
-            except KeyError as ke:
-                # TODO: Is this safe/guaranteed?
-                self.m_mpVarVal[ke.args[0]] = 0
-
-        return "<could not format>"
+        try:
+            return layout.Text(strIn).StrFormat(self.m_mpVarVal)
+        except ValueError:
+            return "<could not format>"
 
     def RunChanges(self, room):
         """Apply any changes for the given room to this session"""
@@ -199,21 +418,39 @@ class Session:
     def TryAdjustRoom(self, dPost, handler):
         """Handles any commands in dPost that could adjust the current room, etc."""
 
-        # No adjustment if we're not asked to go anywhere
+        with self.Lock():
+            self.TryAdjustRoomLocked(dPost, handler)
 
-        if 'dest' not in dPost:
-            return
+    def TryAdjustRoomLocked(self, dPost, handler):
+        # bad coupling here
 
-        dest = dPost['dest']
+        rooms = server.g_server.m_rooms
 
-        # NOTE it appears that spaces get turned into plus signs on form submit, so undo that here
+        # the layout may have been reloaded since we last moved (possibly mid-request, after the
+        #  reload re-pointed every session)
 
-        dest = dest.replace('+', ' ')
+        self.RepointRoom(rooms)
 
-        # bad coupling here
+        # Our own forms say which exit of the current room was picked, which maps straight to the
+        #  destination room. Ids are only meaningful within one layout, so if our room didn't
+        #  survive a reload (we're still in the old one) the key is ignored in favor of dest.
 
-        rooms = server.g_server.m_rooms
-        roomNext = rooms.Room(dest)
+        roomCur = self.RoomCur()
+        idNext = None
+        if roomCur.m_strGen == rooms.m_strGen:
+            idNext = roomCur.IdDestFromExitKey(dPost.get('exit'))
+
+        if idNext is not None:
+            roomNext = rooms.RoomFromId(idNext)
+            dest = roomNext.m_name
+        else:
+            # No adjustment if we're not asked to go anywhere
+
+            if 'dest' not in dPost:
+                return
+
+            dest = dPost['dest']
+            roomNext = rooms.Room(dest)
 
         # provide some debug output for what's going on
 
@@ -224,7 +461,8 @@ class Session:
                         legit='(valid)' if roomNext else '(invalid)'))
 
         if roomNext:
-            self.RunChanges(roomNext)
+            with tracing.g_tracer.Span('RunChanges'):
+                self.RunChanges(roomNext)
             self.SetRoomCur(roomNext)
 
         # TODO do we need handling for the case where the room doesn't exist? just leaving the player there is weird, I guess?
@@ -234,7 +472,7 @@ class Session:
         
         if isinstance(cond, dict):
             if len(cond) != 1:
-                return false
+                return False
 
             if 'and' in cond:
                 lCond = cond['and']
@@ -294,52 +532,47 @@ class Session:
 
         # exits that do not have a condition should always be provided
 
-        if 'cond' not in exit:
+        if exit.m_fnCond is None:
             return True
 
-        return self.FEvaluateCond(exit['cond'])
+        return exit.m_fnCond(self.m_mpVarVal)
 
-    def LStrTryAddExit(self, exit, sid):
-        """Returns the list of form strings for the exit if it is legal, and empty list otherwise"""
+    def RenderRoomCur(self, sid, handler):
+        """Renders the current room, with appropriate settings, etc., to the given handler"""
 
-        # skip invalid exits (no name or verb)
+        sStart = time.perf_counter()
 
-        if 'name' not in exit:
-            return []
+        # the page is built under the lock, so it shows one consistent state, but sent after it's
+        #  released so a slow client doesn't hold up other requests
 
-        if 'verb' not in exit:
-            return []
+        with tracing.g_tracer.Span('RenderRoomCur'):
+            with self.Lock():
+                room = self.RoomCur()
+                abOut = self.AbRenderRoomCur(sid)
 
-        if not self.FShouldProvideExit(exit):
-            return []
+        metrics.g_metrics.Observe('webadv_render_seconds', '', time.perf_counter() - sStart)
 
-        # NOTE that by using a separate form for each exit, we can thus include the index as a different
-        #  value so that we can distinguish which exit was selected
+        with tracing.g_tracer.Span('write'):
+            contentcoding.g_coder.Send(handler, 200, abOut)
 
-        lStr = []
-        lStr.append('<form action="/room" method="post">')
-        lStr.append('<input type="hidden" name="sid" id="sid" value="{sid}"/>'.format(sid=sid))
-        lStr.append('<input type="hidden" name="cur" id="cur" value="{cur}"/>'.format(cur=self.RoomCur().m_name))
-        lStr.append('<input type="hidden" name="dest" id="dest" value="{dest}"/>'.format(dest=exit['name']))
-        lStr.append('<input type="submit" value="{verb}"/>'.format(verb=self.StrFormatSmart(exit['verb'])))
-        lStr.append('</form>')
+        # provide debug output for what's going on
 
-        return lStr
+        # HINT: should be able to make a fairly simple adjustment to this to show the type of room in addition
+        #  to its name
 
-    def RenderRoomCur(self, sid, handler):
-        """Renders the current room, with appropriate settings, etc., to the given handler"""
+        handler.log_message("Rendered room '{name}'".format(name=room.m_name))
+
+    def AbRenderRoomCur(self, sid):
+        """The page for the current room, as bytes"""
         
         # TODO should cache contents for reload scenarios...maybe? maybe skip adjust if we find a reload?
 
+        # The static parts of the page are precompiled by Room.CompilePage; we just fill in the slots
+
         room = self.RoomCur()
+        abSid = sid.encode()
 
-        lStr = []
-        lStr.append('<html>')
-        lStr.append('<head>')
-        lStr.append('<title>{name}</title>'.format(name=room.m_name))
-        lStr.append('</head>')
-        lStr.append('<body>')
-        lStr.append('<h1>{name}</h1>'.format(name=room.m_name))
+        lAb = [room.m_abPageHead]
 
         # Note that we pass the var/val dictionary here for formatting purposes in case the
         #  description wants to include things about current session state
@@ -347,46 +580,191 @@ class Session:
         # HINT: if we make a Desc() function on the room, we can make it be smart about returning
         #  text for regular rooms and the right divs and such for grids
 
-        lStr.append('<p>{desc}</p>'.format(desc=self.StrFormatSmart(room.m_desc)))
+        if room.m_abDesc is not None:
+            lAb.append(room.m_abDesc)
+        else:
+            with tracing.g_tracer.Span('StrFormat desc'):
+                lAb.append(room.m_textDesc.StrFormat(self.m_mpVarVal).encode())
 
-        for exit in room.LExit():
-            lStr.extend(self.LStrTryAddExit(exit, sid))
+        lAb.append(room.m_abPageMid)
 
-        # TODO add generic links for logout, about, any others here
+        # exit conditions and verb formatting
 
-        lStr.append('</body>')
-        lStr.append('</html>')
+        with tracing.g_tracer.Span('exits'):
+            for exit in room.m_lExitPage:
+                if not self.FShouldProvideExit(exit):
+                    continue
 
-        abOut = '\n'.join(lStr).encode()
+                lAb.append(exit.m_abFormPre)
+                lAb.append(abSid)
+                lAb.append(exit.m_abFormMid)
+                if exit.m_abVerb is not None:
+                    lAb.append(exit.m_abVerb)
+                else:
+                    lAb.append(exit.m_textVerb.StrFormat(self.m_mpVarVal).encode())
+                lAb.append(exit.m_abFormPost)
 
-        handler.send_response(200)
-        handler.send_header('Content-Length', len(abOut))
-        handler.end_headers()
+        lAb.append(room.m_abPageTail)
 
-        handler.wfile.write(abOut)
+        return b''.join(lAb)
 
-        # provide debug output for what's going on
+class Flusher:
+    """Write-behind persistence: dirty sessions are queued (one entry per session, however many times
+    it changes) and saved in batches by a background thread"""
 
-        # HINT: should be able to make a fairly simple adjustment to this to show the type of room in addition
-        #  to its name
+    s_cTryStop = 3              # flushes tried at shutdown before giving up on failed saves
+    s_sRetryStop = 1.0
 
-        handler.log_message("Rendered room '{name}'".format(name=room.m_name))
+    def __init__(self, sInterval, cDirtyMax):
+        self.m_sInterval = sInterval
+        self.m_cDirtyMax = cDirtyMax
+        self.m_mpUidSession = {}
+        self.m_sQueuedOldest = None
+        self.m_cFlushed = 0
+        self.m_fStop = False
+        self.m_cond = threading.Condition()
+        self.m_lockFlush = threading.Lock()
+        self.m_thread = threading.Thread(target=self.RunThread, name='flusher', daemon=True)
+        self.m_thread.start()
+
+    def Enqueue(self, session):
+        """Note that session needs saving; wakes the flusher early if enough sessions are waiting"""
+
+        with self.m_cond:
+            if not self.m_mpUidSession:
+                self.m_sQueuedOldest = time.monotonic()
+
+            self.m_mpUidSession[session.m_uid] = session
+
+            if len(self.m_mpUidSession) >= self.m_cDirtyMax:
+                self.m_cond.notify()
+
+    def RunThread(self):
+        while True:
+            with self.m_cond:
+                self.m_cond.wait_for(
+                        lambda: self.m_fStop or len(self.m_mpUidSession) >= self.m_cDirtyMax,
+                        timeout=self.m_sInterval)
+                fStop = self.m_fStop
+
+            self.Flush()
+
+            if fStop:
+                return
+
+    def Flush(self):
+        """Save everything queued so far"""
+
+        with self.m_lockFlush:
+            with self.m_cond:
+                lSession = list(self.m_mpUidSession.values())
+                self.m_mpUidSession = {}
+                self.m_sQueuedOldest = None
+
+            # a failed save (disk full, database locked, ...) is queued again for the next flush;
+            #  anything escaping here would quietly end the flusher thread
+
+            cSaved = 0
+            for session in lSession:
+                try:
+                    session.Save()
+                    cSaved += 1
+                except Exception as err:
+                    print("Failed to save session {u}, will retry: {e!r}".format(u=session.m_uid, e=err))
+                    self.Enqueue(session)
+
+            self.m_cFlushed += cSaved
+
+    def CDirty(self):
+        """Number of sessions waiting to be saved"""
+
+        return len(self.m_mpUidSession)
+
+    def SLag(self):
+        """How long (seconds) the oldest unsaved change has been waiting, 0 if nothing is waiting"""
+
+        sQueuedOldest = self.m_sQueuedOldest
+        if sQueuedOldest is None:
+            return 0.0
+
+        return time.monotonic() - sQueuedOldest
+
+    def Stop(self):
+        """Stop the background thread and write everything queued, trying failed saves again a few
+        times. Returns the uids of any sessions that still couldn't be saved."""
+
+        with self.m_cond:
+            self.m_fStop = True
+            self.m_cond.notify()
+
+        self.m_thread.join()
+
+        # the thread's last flush may have re-queued failures; nothing else will pick them up now
+
+        for iTry in range(self.s_cTryStop):
+            if not self.m_mpUidSession:
+                break
+            if iTry > 0:
+                time.sleep(self.s_sRetryStop)
+            self.Flush()
+
+        return sorted(self.m_mpUidSession)
 
 class Group:
     """All of the sessions known by the system"""
 
+    s_strExtSession = '.session'
+    s_cPathParallelMin = 256    # below this, starting worker processes costs more than it saves
+
     def __init__(self):
-        self.m_mpUidSession = {}
+        self.m_mpUidSession = collections.OrderedDict()    # kept in least to most recently used order
+        self.m_mpUidPath = {}       # sessions on disk that can be loaded on demand
+        self.m_cSessionMax = 0
+        self.m_cEvicted = 0
+        self.m_mpStrPhaseS = {}     # startup phase -> seconds spent in it
         self.m_pathDir = None
+        self.m_flusher = None
+        self.m_store = None
+        self.m_rooms = None
+        self.m_fShared = False
+        self.m_lockLoad = threading.Lock()
 
-    def Load(self, pathDir):
-        """load all files from the directory, assuming they're sessions"""
+    def Load(self, pathDir, fLazy=False, cProc=1):
+        """load all files from the directory, assuming they're sessions. If fLazy, files named
+        <uid>.session are only indexed here, and get parsed the first time the uid is asked for.
+        With cProc > 1, files are parsed in parallel by that many worker processes."""
 
         self.m_pathDir = pathDir
 
+        if self.m_store is not None:
+            sStart = time.perf_counter()
+            self.LoadStore()
+            self.m_mpStrPhaseS['store'] = time.perf_counter() - sStart
+            return
+
+        sStart = time.perf_counter()
+
+        lPath = []
         for path in glob.glob("{p}/*".format(p=pathDir)):
+            if fLazy and path.endswith(self.s_strExtSession):
+                uid = os.path.basename(path)[:-len(self.s_strExtSession)]
+                self.m_mpUidPath[uid] = path
+            else:
+                lPath.append(path)
+
+        sGlob = time.perf_counter()
+        self.m_mpStrPhaseS['glob'] = sGlob - sStart
+
+        lDoc = self.LDocParse(lPath, cProc)
+
+        sParse = time.perf_counter()
+        self.m_mpStrPhaseS['parse'] = sParse - sGlob
+
+        for path, doc in zip(lPath, lDoc):
             session = Session()
-            session.Load(path)
+            session.m_path = path
+            if doc is not None:
+                session.LoadDoc(doc)
             strErrors = session.StrErrors()
             if strErrors:
                 print("Session from {p} had errors:\n{e}".format(p=path, e=strErrors))
@@ -398,29 +776,315 @@ class Group:
             else:
                 self.m_mpUidSession[session.m_uid] = session
 
+        self.m_mpStrPhaseS['validate'] = time.perf_counter() - sParse
+
+    def LDocParse(self, lPath, cProc):
+        """Parse every file in lPath, in order, fanning out to worker processes if worthwhile"""
+
+        if cProc <= 1 or len(lPath) < self.s_cPathParallelMin:
+            return LDocLoadPaths(lPath)
+
+        # hand out files in batches, a few per worker, to keep the per-task overhead down
+
+        cPathBatch = max(1, len(lPath) // (cProc * 4))
+        llPath = [lPath[i:i + cPathBatch] for i in range(0, len(lPath), cPathBatch)]
+
+        lDoc = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=cProc) as executor:
+            for lDocBatch in executor.map(LDocLoadPaths, llPath):
+                lDoc.extend(lDocBatch)
+
+        return lDoc
+
+    def StrTimings(self):
+        """Startup timing breakdown, e.g. for printing once the server is ready"""
+
+        return ', '.join('{p} {s:.3f}s'.format(p=strPhase, s=s) for strPhase, s in self.m_mpStrPhaseS.items())
+
+    def LoadStore(self):
+        """load all sessions from the store set via SetStore (lazy stores load on demand instead)"""
+
+        for doc in self.m_store.LDocLoad():
+            session = self.SessionCreate()
+            session.LoadDoc(doc)
+            strErrors = session.StrErrors()
+            if strErrors:
+                print("Session {u} from store had errors:\n{e}".format(u=session.m_uid, e=strErrors))
+            else:
+                self.m_mpUidSession[session.m_uid] = session
+
+    def SetStore(self, store):
+        """Keep sessions in the given store instead of one yaml file per session (call before Load)"""
+
+        self.m_store = store
+
+    def SetSessionMax(self, cSessionMax):
+        """Keep at most cSessionMax sessions in memory, evicting the least recently used idle ones
+        (only sessions that can be loaded again later are ever evicted). 0 means no limit."""
+
+        self.m_cSessionMax = cSessionMax
+
     def InitRooms(self, rooms):
         """initialize actual room references for each session (typically after loading)"""
 
+        sStart = time.perf_counter()
+
+        self.m_rooms = rooms
+
         for session in self.m_mpUidSession.values():
             room = rooms.Room(session.m_roomSaved)
             session.SetRoomCur(room)
 
+        self.m_mpStrPhaseS['InitRooms'] = time.perf_counter() - sStart
+
+    def SetShared(self):
+        """Other processes write the same (lazy) store, so never serve a session from memory: each
+        lookup reads it fresh, and new sessions only go to the store"""
+
+        self.m_fShared = True
+
     def SessionFromUid(self, uid):
-        return self.m_mpUidSession.get(uid, None)
+        if self.m_fShared:
+            return self.SessionLoadShared(uid)
+
+        session = self.m_mpUidSession.get(uid, None)
+        if session is not None:
+            if self.m_cSessionMax:
+                # it may have been evicted since the lookup; that's fine, it just isn't touched
+
+                with self.m_lockLoad:
+                    if self.m_mpUidSession.get(uid) is session:
+                        self.m_mpUidSession.move_to_end(uid)
+            return session
+
+        if self.FCanLoadLazy(uid):
+            return self.SessionLoadLazy(uid)
+
+        return None
+
+    def SessionPinFromUid(self, uid):
+        """SessionFromUid, but the session stays in memory, as the one for uid, until Unpin; so a
+        sid registered for it in between (say, after a slow login) is bound to the live session
+        rather than an evicted copy"""
+
+        while True:
+            session = self.SessionFromUid(uid)
+            if session is None or self.m_fShared:
+                return session
+
+            # it may have been evicted since the lookup; if so, look again
+
+            with self.m_lockLoad:
+                if self.m_mpUidSession.get(uid) is session:
+                    session.m_cPin += 1
+                    return session
+
+    def Unpin(self, session):
+        """Undo a SessionPinFromUid; the session can be evicted again once nothing else holds it"""
+
+        if self.m_fShared:
+            return
+
+        with self.m_lockLoad:
+            session.m_cPin -= 1
+            self.EvictIdle()
+
+    def SessionLoadLazy(self, uid):
+        """Parse the session for uid from its indexed file or from a lazy store, or return None if
+        there isn't one"""
+
+        if uid is None:
+            return None
+
+        with self.m_lockLoad:
+            # someone else may have loaded it while we waited
+
+            session = self.m_mpUidSession.get(uid, None)
+            if session is not None:
+                return session
+
+            if self.m_store is None:
+                if uid not in self.m_mpUidPath:
+                    return None
+
+                session = self.SessionCreate()
+                try:
+                    session.Load(self.m_mpUidPath[uid])
+                except OSError as err:
+                    print("Session {u} could not be loaded: {e}".format(u=uid, e=err))
+                    return None
+            else:
+                doc = self.m_store.DocFromUid(uid)
+                if doc is None:
+                    return None
+
+                session = self.SessionCreate()
+                session.LoadDoc(doc)
+
+            strErrors = session.StrErrors()
+            if strErrors:
+                print("Session {u} had errors:\n{e}".format(u=uid, e=strErrors))
+                return None
+
+            if session.m_uid != uid:
+                print("Session file for {u} has uid {uOther}".format(u=uid, uOther=session.m_uid))
+                return None
+
+            session.ResolveRoom(self.m_rooms)
+            self.m_mpUidSession[uid] = session
+            self.EvictIdle()
+
+            return session
+
+    def SessionLoadShared(self, uid):
+        """Read the session for uid straight from the store, or return None if there isn't one"""
+
+        if uid is None:
+            return None
+
+        doc = self.m_store.DocFromUid(uid)
+        if doc is None:
+            return None
+
+        session = self.SessionCreate()
+        session.LoadDoc(doc)
+
+        strErrors = session.StrErrors()
+        if strErrors:
+            print("Session {u} had errors:\n{e}".format(u=uid, e=strErrors))
+            return None
+
+        session.ResolveRoom(self.m_rooms)
+        return session
+
+    def FCanEvict(self, session):
+        """True if session can be dropped from memory: no unsaved changes, no live sids, not pinned,
+        and we know how to load it again"""
+
+        if session.m_fIsDirty or session.m_cSidLive > 0 or session.m_cPin > 0:
+            return False
+
+        return self.FCanLoadLazy(session.m_uid)
+
+    def FCanLoadLazy(self, uid):
+        """True if uid's session can be (re)loaded on demand: from the store when there is one (if
+        it's a lazy store), otherwise from its indexed file"""
+
+        if self.m_store is not None:
+            return self.m_store.s_fLazy
+
+        return uid in self.m_mpUidPath
+
+    def DropIfIdle(self, session):
+        """Drop session from memory now if FCanEvict allows it (e.g. once its sids have expired)"""
+
+        with self.m_lockLoad:
+            if self.m_mpUidSession.get(session.m_uid) is session and self.FCanEvict(session):
+                del self.m_mpUidSession[session.m_uid]
+                self.m_cEvicted += 1
+
+    def EvictIdle(self):
+        """Drop least recently used idle sessions until we're within m_cSessionMax (m_lockLoad held)"""
+
+        if not self.m_cSessionMax:
+            return
+
+        cEvict = len(self.m_mpUidSession) - self.m_cSessionMax
+        if cEvict <= 0:
+            return
+
+        for uid, session in list(self.m_mpUidSession.items()):
+            if cEvict <= 0:
+                break
+            if self.FCanEvict(session):
+                del self.m_mpUidSession[uid]
+                self.m_cEvicted += 1
+                cEvict -= 1
 
     def SessionCreate(self):
         """Generate untracked "blank" session"""
-        return Session()
+        session = Session()
+        session.m_store = self.m_store
+        return session
 
     def LSession(self):
         """Return list (or generator) of sessions in the group"""
 
         return self.m_mpUidSession.values()
 
-    def AddSession(self, session):
-        """Adds the given session to the group"""
+    def FAddSession(self, session):
+        """Adds the given session to the group, unless its uid is already taken, in which case this
+        returns False. Checking and adding are one step, so of two concurrent creates of the same
+        uid exactly one succeeds (when shared, that's settled by the store, across processes)."""
+
+        if self.m_fShared:
+            return self.m_store.FClaim(session.DDoc())
+
+        uid = session.m_uid
+        with self.m_lockLoad:
+            if uid in self.m_mpUidSession or uid in self.m_mpUidPath:
+                return False
+            if self.m_store is not None and self.m_store.s_fLazy and self.m_store.DocFromUid(uid) is not None:
+                return False
+
+            self.m_mpUidSession[uid] = session
+
+            # with a store, the session is saved there and never to its path
+
+            if self.m_store is None and session.m_path is not None and session.m_path.endswith(self.s_strExtSession):
+                self.m_mpUidPath[uid] = session.m_path
+            self.EvictIdle()
+
+        return True
+
+    def SwapRooms(self, rooms):
+        """Switch to a reloaded layout, re-pointing every loaded session at its room by name. Returns
+        how many sessions are in rooms the new layout no longer has (they stay where they are)."""
+
+        with self.m_lockLoad:
+            self.m_rooms = rooms
+            lSession = list(self.m_mpUidSession.values())
+
+        cMissing = 0
+        for session in lSession:
+            if not session.RepointRoom(rooms):
+                cMissing += 1
+
+        return cMissing
+
+    def StartWriteBehind(self, sInterval, cDirtyMax):
+        """Switch FSaveSession over to queued saves, flushed every sInterval seconds or whenever
+        cDirtyMax sessions are waiting, whichever comes first"""
+
+        self.m_flusher = Flusher(sInterval, cDirtyMax)
+
+    def FSaveSession(self, session):
+        """Persist the session, either right away or via the write-behind queue. When shared, it's
+        only written if no other request (in any process) has saved it since it was read; if one
+        has, nothing is written and this returns False."""
+
+        if self.m_fShared:
+            return session.FSaveIfUnchanged()
+
+        if self.m_flusher is None:
+            session.Save()
+        else:
+            self.m_flusher.Enqueue(session)
+
+        return True
+
+    def Shutdown(self):
+        """Final flush of anything not yet persisted. Returns the uids of sessions whose changes
+        couldn't be saved (and are lost)."""
+
+        lUidUnsaved = []
+        if self.m_flusher is not None:
+            lUidUnsaved = self.m_flusher.Stop()
+
+        if self.m_store is not None:
+            self.m_store.Close()
 
-        self.m_mpUidSession[session.m_uid] = session
+        return lUidUnsaved
 
 if __name__ == '__main__':
     # test driver for session stuff
@@ -0,0 +1,383 @@
+# session storage backends (alternatives to one yaml file per session)
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+
+class Store:
+    """Interface for where Group/Session keep session documents. A document is the dict produced by
+    Session.DDoc: uid, pwd, room (name) and vars."""
+
+    # lazy stores don't hand back every session at startup; Group asks for them by uid as needed
+
+    s_fLazy = False
+
+    def LDocLoad(self):
+        """Returns the documents to load at startup (lazy stores may return an empty list)"""
+        raise NotImplementedError()
+
+    def DocFromUid(self, uid):
+        """Returns the document for uid, or None if there isn't one (only needed for lazy stores)"""
+        return None
+
+    def Save(self, doc, docPrev):
+        """Persist doc; docPrev is the last document saved for this session (or None)"""
+        raise NotImplementedError()
+
+    def FSaveIfUnchanged(self, doc, docPrev):
+        """Persist doc only if the stored session is still the one read as docPrev (nobody else has
+        saved it since), returning False if it isn't; on success doc is marked as the new version.
+        Only needed for stores shared between processes."""
+        raise NotImplementedError()
+
+    def FClaim(self, doc):
+        """Persist doc as a new session, unless one with its uid already exists, in which case this
+        returns False (only needed for stores shared between processes)"""
+        raise NotImplementedError()
+
+    def Close(self):
+        """Make sure everything saved is on disk and release any resources"""
+        pass
+
+
+
+class JournalStore(Store):
+    """Keeps every session in a single append-only journal, plus a snapshot that the journal is
+    periodically compacted into. Each save appends one small record with just what changed."""
+
+    s_strSnapshot = 'snapshot.jsonl'
+    s_strJournal = 'journal.jsonl'
+    s_strJournalOld = 'journal.jsonl.old'
+    s_cRecordCompact = 10000
+
+    def __init__(self, pathDir, cRecordCompact=None):
+        self.m_pathDir = pathDir
+        self.m_cRecordCompact = cRecordCompact or self.s_cRecordCompact
+        self.m_cRecord = 0
+        self.m_fileJournal = None
+        self.m_lock = threading.Lock()
+        self.m_threadCompact = None
+
+        os.makedirs(pathDir, exist_ok=True)
+
+    def Path(self, strName):
+        return os.path.join(self.m_pathDir, strName)
+
+    def LDocLoad(self):
+        """Replay snapshot + journal, returning the list of session documents"""
+
+        mpUidDoc = {}
+
+        # NOTE a journal.old is only left behind if we stopped partway through a compaction. Records
+        #  hold new values rather than increments, so replaying it again on top of a snapshot that
+        #  already includes it is harmless
+
+        self.CRecordReplay(self.Path(self.s_strSnapshot), mpUidDoc)
+        self.CRecordReplay(self.Path(self.s_strJournalOld), mpUidDoc)
+        self.m_cRecord = self.CRecordReplay(self.Path(self.s_strJournal), mpUidDoc)
+
+        self.m_fileJournal = open(self.Path(self.s_strJournal), 'a')
+
+        if self.m_cRecord >= self.m_cRecordCompact:
+            self.m_threadCompact = threading.Thread(target=self.Compact, name='compactor', daemon=True)
+            self.m_threadCompact.start()
+
+        return list(mpUidDoc.values())
+
+    @staticmethod
+    def CRecordReplay(path, mpUidDoc):
+        """Apply each record in the file at path to mpUidDoc, returning the number of records"""
+
+        if not os.path.exists(path):
+            return 0
+
+        cRecord = 0
+        with open(path, 'r') as fileIn:
+            for strLine in fileIn:
+                try:
+                    record = json.loads(strLine)
+                except ValueError:
+                    # torn write at the end of the journal from a crash; everything before it is fine
+                    print("Skipping bad journal record in {p}".format(p=path))
+                    continue
+
+                cRecord += 1
+                JournalStore.ApplyRecord(record, mpUidDoc)
+
+        return cRecord
+
+    @staticmethod
+    def ApplyRecord(record, mpUidDoc):
+        uid = record['u']
+        doc = mpUidDoc.get(uid)
+        if doc is None:
+            doc = {'uid' : uid, 'pwd' : None, 'room' : None, 'vars' : {}}
+            mpUidDoc[uid] = doc
+
+        if 'p' in record:
+            doc['pwd'] = record['p']
+        if 'r' in record:
+            doc['room'] = record['r']
+        if 'v' in record:
+            doc['vars'].update(record['v'])
+
+    @staticmethod
+    def RecordFromDocs(doc, docPrev):
+        """Compact record holding only the parts of doc that differ from docPrev"""
+
+        record = {'u' : doc['uid']}
+
+        if docPrev is None or docPrev.get('uid') != doc['uid']:
+            record['p'] = doc['pwd']
+            record['r'] = doc['room']
+            record['v'] = doc['vars']
+            return record
+
+        if doc['pwd'] != docPrev.get('pwd'):
+            record['p'] = doc['pwd']
+
+        if doc['room'] != docPrev.get('room'):
+            record['r'] = doc['room']
+
+        mpVarValPrev = docPrev.get('vars') or {}
+        mpVarValChanged = {var : val for var, val in doc['vars'].items() if mpVarValPrev.get(var) != val}
+        if mpVarValChanged:
+            record['v'] = mpVarValChanged
+
+        return record
+
+    def Save(self, doc, docPrev):
+        """Append the changes between docPrev (last saved, may be None) and doc to the journal"""
+
+        record = self.RecordFromDocs(doc, docPrev)
+        if len(record) == 1:
+            return
+
+        strLine = json.dumps(record, separators=(',', ':')) + '\n'
+
+        with self.m_lock:
+            self.m_fileJournal.write(strLine)
+            self.m_fileJournal.flush()
+            self.m_cRecord += 1
+
+            fCompact = self.m_cRecord >= self.m_cRecordCompact and self.m_threadCompact is None
+            if fCompact:
+                self.m_threadCompact = threading.Thread(target=self.Compact, name='compactor', daemon=True)
+                self.m_threadCompact.start()
+
+    def Compact(self):
+        """Fold the journal into the snapshot. Saves keep appending to a fresh journal meanwhile."""
+
+        try:
+            # swap in a fresh journal, so the one being folded no longer changes
+
+            with self.m_lock:
+                pathOld = self.Path(self.s_strJournalOld)
+                if os.path.exists(pathOld):
+                    # left over from an interrupted compaction; fold it in first
+                    self.m_fileJournal.close()
+                    with open(pathOld, 'a') as fileOld:
+                        with open(self.Path(self.s_strJournal), 'r') as fileIn:
+                            fileOld.write(fileIn.read())
+                else:
+                    self.m_fileJournal.close()
+                    os.rename(self.Path(self.s_strJournal), pathOld)
+
+                self.m_fileJournal = open(self.Path(self.s_strJournal), 'w')
+                self.m_cRecord = 0
+
+            mpUidDoc = {}
+            self.CRecordReplay(self.Path(self.s_strSnapshot), mpUidDoc)
+            self.CRecordReplay(pathOld, mpUidDoc)
+
+            pathSnapshot = self.Path(self.s_strSnapshot)
+            tmp = pathSnapshot + '.new'
+            with open(tmp, 'w') as fileOut:
+                for doc in mpUidDoc.values():
+                    fileOut.write(json.dumps(self.RecordFromDocs(doc, None), separators=(',', ':')) + '\n')
+                fileOut.flush()
+                os.fsync(fileOut.fileno())
+
+            os.replace(tmp, pathSnapshot)
+            os.remove(pathOld)
+        finally:
+            with self.m_lock:
+                self.m_threadCompact = None
+
+    def Close(self):
+        """Finish any compaction in progress and close the journal"""
+
+        threadCompact = self.m_threadCompact
+        if threadCompact is not None:
+            threadCompact.join()
+
+        with self.m_lock:
+            if self.m_fileJournal is not None:
+                self.m_fileJournal.close()
+                self.m_fileJournal = None
+
+
+
+class SqliteStore(Store):
+    """Keeps sessions in a SQLite database (WAL mode), one row per uid. Sessions are only read when
+    first asked for, and saves are committed in batches rather than one transaction each. Each row
+    has a version, bumped by every save, which documents read from here carry as 'ver'."""
+
+    s_fLazy = True
+    s_cSaveBatch = 200
+    s_sBatch = 0.5
+
+    def __init__(self, path, cSaveBatch=None, sBatch=None):
+        self.m_cSaveBatch = cSaveBatch or self.s_cSaveBatch
+        self.m_sBatch = sBatch or self.s_sBatch
+        self.m_cSavePending = 0
+        self.m_lock = threading.Lock()
+        self.m_fStop = False
+
+        # one connection shared by every request thread (guarded by m_lock), in explicit
+        #  transaction mode so we decide when to commit
+
+        self.m_conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.m_conn.execute('PRAGMA journal_mode=WAL')
+        self.m_conn.execute('PRAGMA synchronous=NORMAL')
+        self.m_conn.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'uid TEXT PRIMARY KEY, pwd TEXT, room TEXT, vars TEXT NOT NULL, ver INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID')
+
+        # databases from before versions were kept get the column added (by whichever worker
+        #  gets there first)
+
+        if not self.FHasColumn('ver'):
+            try:
+                self.m_conn.execute('ALTER TABLE sessions ADD COLUMN ver INTEGER NOT NULL DEFAULT 0')
+            except sqlite3.OperationalError:
+                if not self.FHasColumn('ver'):
+                    raise
+
+        self.m_threadCommit = threading.Thread(target=self.RunCommitThread, name='sqlite-commit', daemon=True)
+        self.m_threadCommit.start()
+
+    def FHasColumn(self, strColumn):
+        return any(row[1] == strColumn for row in self.m_conn.execute('PRAGMA table_info(sessions)'))
+
+    def LDocLoad(self):
+        return []
+
+    def DocFromUid(self, uid):
+        with self.m_lock:
+            row = self.m_conn.execute(
+                    'SELECT uid, pwd, room, vars, ver FROM sessions WHERE uid = ?', (uid,)).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+                'uid' : row[0],
+                'pwd' : row[1],
+                'room' : row[2],
+                'vars' : json.loads(row[3]),
+                'ver' : row[4],
+            }
+
+    def CSession(self):
+        """Total number of stored sessions"""
+
+        with self.m_lock:
+            return self.m_conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def Save(self, doc, docPrev):
+        with self.m_lock:
+            self.ExecuteLocked(
+                    'INSERT INTO sessions (uid, pwd, room, vars) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(uid) DO UPDATE SET pwd=excluded.pwd, room=excluded.room, vars=excluded.vars, ver=ver+1',
+                    (doc['uid'], doc['pwd'], doc['room'], json.dumps(doc['vars'], separators=(',', ':'))))
+
+            if self.m_cSavePending >= self.m_cSaveBatch:
+                self.CommitLocked()
+
+    def FSaveIfUnchanged(self, doc, docPrev):
+        # compare-and-swap on the version, committed right away so the next reader (in any
+        #  process) sees it
+
+        verPrev = docPrev.get('ver') if docPrev is not None else None
+        if verPrev is None:
+            return False
+
+        with self.m_lock:
+            cursor = self.ExecuteLocked(
+                    'UPDATE sessions SET pwd = ?, room = ?, vars = ?, ver = ver + 1 WHERE uid = ? AND ver = ?',
+                    (doc['pwd'], doc['room'], json.dumps(doc['vars'], separators=(',', ':')), doc['uid'], verPrev))
+
+            self.CommitLocked()
+
+        if cursor.rowcount != 1:
+            return False
+
+        doc['ver'] = verPrev + 1
+        return True
+
+    def FClaim(self, doc):
+        # a plain insert, committed right away, so of several processes creating the same uid only
+        #  one gets the row
+
+        with self.m_lock:
+            cursor = self.ExecuteLocked(
+                    'INSERT OR IGNORE INTO sessions (uid, pwd, room, vars) VALUES (?, ?, ?, ?)',
+                    (doc['uid'], doc['pwd'], doc['room'], json.dumps(doc['vars'], separators=(',', ':'))))
+
+            self.CommitLocked()
+
+            return cursor.rowcount == 1
+
+    def ExecuteLocked(self, strSql, args):
+        """Run one write as part of the open batch, starting one if need be (m_lock must be held). A
+        statement that fails (e.g. "database is locked") is undone on its own, via a savepoint, and
+        the error raised; the rest of the batch is unaffected and still commits later."""
+
+        if not self.m_conn.in_transaction:
+            self.m_conn.execute('BEGIN')
+
+        self.m_conn.execute('SAVEPOINT stmt')
+        try:
+            cursor = self.m_conn.execute(strSql, args)
+        except sqlite3.Error:
+            self.m_conn.execute('ROLLBACK TO stmt')
+            self.m_conn.execute('RELEASE stmt')
+            raise
+        self.m_conn.execute('RELEASE stmt')
+
+        self.m_cSavePending += 1
+        return cursor
+
+    def CommitLocked(self):
+        """Commit the open batch, if any (m_lock must be held). If the commit fails the batch stays
+        open, to be committed by a later call."""
+
+        if self.m_conn.in_transaction:
+            self.m_conn.execute('COMMIT')
+            self.m_cSavePending = 0
+
+    def RunCommitThread(self):
+        """Make sure a partial batch never waits more than m_sBatch to be committed"""
+
+        while not self.m_fStop:
+            time.sleep(self.m_sBatch)
+            with self.m_lock:
+                if self.m_conn is not None:
+                    try:
+                        self.CommitLocked()
+                    except sqlite3.Error as err:
+                        print("Failed to commit sessions, will retry: {e}".format(e=err))
+
+    def Close(self):
+        self.m_fStop = True
+        self.m_threadCommit.join()
+
+        with self.m_lock:
+            self.CommitLocked()
+            self.m_conn.close()
+            self.m_conn = None
@@ -0,0 +1,181 @@
+# per-request trace spans (sampled, written as Chrome trace events) and opt-in cProfile aggregation
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import signal
+import threading
+import time
+
+class SpanNull:
+    """What Tracer.Span hands back when the current request isn't being traced"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typeExc, exc, tb):
+        return False
+
+s_spanNull = SpanNull()
+
+class SpanActive:
+    def __init__(self, trace, name):
+        self.m_trace = trace
+        self.m_name = name
+        self.m_usStart = None
+
+    def __enter__(self):
+        self.m_usStart = time.perf_counter() * 1e6
+        return self
+
+    def __exit__(self, typeExc, exc, tb):
+        self.m_trace.AddEvent(self.m_name, self.m_usStart, time.perf_counter() * 1e6 - self.m_usStart)
+        return False
+
+class Trace:
+    """The spans recorded for one sampled request"""
+
+    def __init__(self, name, dArgs):
+        self.m_name = name
+        self.m_dArgs = dArgs
+        self.m_tid = threading.get_ident()
+        self.m_lEvent = []
+        self.m_usStart = time.perf_counter() * 1e6
+
+    def AddEvent(self, name, usStart, usDur):
+        self.m_lEvent.append({
+                'name' : name,
+                'ph' : 'X',
+                'ts' : round(usStart, 1),
+                'dur' : round(usDur, 1),
+                'pid' : os.getpid(),
+                'tid' : self.m_tid,
+            })
+
+class Tracer:
+    """Samples a fraction of requests and records nested spans for them (Span used as a context
+    manager anywhere in the request's thread). Each finished trace is appended to the trace file
+    as Chrome trace events (JSON array format, which viewers accept without the closing bracket),
+    so it can be opened in chrome://tracing or Perfetto. Requests that aren't sampled pay one
+    attribute check per span."""
+
+    def __init__(self):
+        self.m_fileOut = None
+        self.m_fraction = 0.0
+        self.m_local = threading.local()
+        self.m_lock = threading.Lock()
+
+    def Open(self, path, fraction):
+        """Start sampling fraction (0..1) of requests into the trace file at path"""
+
+        self.m_fileOut = open(path, 'w')
+        self.m_fileOut.write('[\n')
+        self.m_fileOut.flush()
+        self.m_fraction = fraction
+
+    def Begin(self, name, dArgs=None):
+        """Start a trace for the request about to run on this thread, if it's sampled. Returns the
+        trace (or None), which must be passed to End."""
+
+        if self.m_fileOut is None or random.random() >= self.m_fraction:
+            return None
+
+        trace = Trace(name, dArgs)
+        self.m_local.trace = trace
+        return trace
+
+    def Span(self, name):
+        if self.m_fileOut is None:
+            return s_spanNull
+
+        trace = getattr(self.m_local, 'trace', None)
+        if trace is None:
+            return s_spanNull
+
+        return SpanActive(trace, name)
+
+    def End(self, trace):
+        if trace is None:
+            return
+
+        self.m_local.trace = None
+
+        usEnd = time.perf_counter() * 1e6
+        trace.AddEvent(trace.m_name, trace.m_usStart, usEnd - trace.m_usStart)
+        if trace.m_dArgs:
+            trace.m_lEvent[-1]['args'] = trace.m_dArgs
+
+        strOut = ''.join(json.dumps(event, separators=(',', ':')) + ',\n' for event in trace.m_lEvent)
+
+        with self.m_lock:
+            self.m_fileOut.write(strOut)
+            self.m_fileOut.flush()
+
+g_tracer = Tracer()
+
+class Profiler:
+    """Runs request dispatch under cProfile. Each request gets its own profile (a profiler can
+    only watch the thread that enabled it), which is folded into a running total afterwards; on
+    SIGUSR1 the total is written to pathOut (a pstats file) and the top entries are printed."""
+
+    s_cLinePrint = 30
+
+    def __init__(self, pathOut):
+        self.m_pathOut = pathOut
+        self.m_stats = None
+        self.m_cRequest = 0
+        self.m_lock = threading.Lock()
+        self.m_eventDump = threading.Event()
+
+    def Start(self):
+        # the handler only wakes the dump thread, since the signal may land while this process's
+        #  main thread is itself in Run holding m_lock (the asyncio engine dispatches there)
+
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.m_eventDump.set())
+
+        thread = threading.Thread(target=self.RunDumpThread, name='profile-dump', daemon=True)
+        thread.start()
+
+    def Run(self, fn, *args):
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # newer pythons allow only one active profiler per process; this request goes unprofiled
+            return fn(*args)
+
+        try:
+            return fn(*args)
+        finally:
+            prof.disable()
+            with self.m_lock:
+                if self.m_stats is None:
+                    self.m_stats = pstats.Stats(prof)
+                else:
+                    self.m_stats.add(prof)
+                self.m_cRequest += 1
+
+    def RunDumpThread(self):
+        while True:
+            self.m_eventDump.wait()
+            self.m_eventDump.clear()
+            self.Dump()
+
+    def Dump(self):
+        with self.m_lock:
+            if self.m_stats is None:
+                print("Profile: no requests yet")
+                return
+
+            self.m_stats.dump_stats(self.m_pathOut)
+
+            fileOut = io.StringIO()
+            self.m_stats.stream = fileOut
+            self.m_stats.sort_stats('cumulative').print_stats(self.s_cLinePrint)
+            cRequest = self.m_cRequest
+
+        print("Profile of {c} requests written to {p}".format(c=cRequest, p=self.m_pathOut))
+        print(fileOut.getvalue())